@@ -5,22 +5,24 @@ from typing import List
 from typing import Literal
 from typing import Optional
 from typing import Union
-from typing import cast
 
 import numpy as np
 import pandas as pd
 from scipy.optimize import minimize
 from scipy.special import polygamma  # type: ignore
-from scipy.stats import f  # type: ignore
 from scipy.stats import trim_mean  # type: ignore
 
 from deconveil.default_inference import DefInference                              
 from deconveil.inference import Inference                                     
 from deconveil import utils_CNaware
+from deconveil.utils_CNaware import cooks_distances
 from deconveil.utils_CNaware import fit_rough_dispersions
 from deconveil.utils_CNaware import fit_moments_dispersions2
 from deconveil.utils_CNaware import grid_fit_beta
 from deconveil.utils_CNaware import irls_glm
+from deconveil.utils_CNaware import normed_means
+from deconveil.utils_CNaware import trimmed_mean_cols
+from deconveil.utils_CNaware import trimmed_sf_nll
 
 from pydeseq2.preprocessing import deseq2_norm_fit
 from pydeseq2.preprocessing import deseq2_norm_transform
@@ -28,11 +30,14 @@ from pydeseq2.utils import build_design_matrix
 from pydeseq2.utils import dispersion_trend
 from pydeseq2.utils import mean_absolute_deviation
 from pydeseq2.utils import n_or_more_replicates
-from pydeseq2.utils import nb_nll
 from pydeseq2.utils import replace_underscores
 from pydeseq2.utils import robust_method_of_moments_disp
 from pydeseq2.utils import test_valid_counts
-from pydeseq2.utils import trimmed_mean
+
+# Bits of the per-gene status bytes in ``deconveil_fit._gene_flags``
+_NON_ZERO = np.uint8(1)
+_ABOVE_MIN_DISP = np.uint8(2)
+_OUTLIER = np.uint8(4)
 
 
 class deconveil_fit:
@@ -151,13 +156,28 @@ class deconveil_fit:
         Initialize object
         """
         self.data={}
-        self.data["counts"] = counts
-        self.data["counts"] = self.data["counts"].astype(int)
+        # Only cast (and copy) the counts if they are not integers already
+        if all(pd.api.types.is_integer_dtype(dtype) for dtype in counts.dtypes):
+            self.data["counts"] = counts
+        else:
+            self.data["counts"] = counts.astype(int)
         self.data["cnv"] = cnv
 
         if self.data["counts"].shape[0] != self.data["cnv"].shape[0] and self.data["counts"].shape[1] != self.data["cnv"].shape[1]:
             raise ValueError("Matrices must have the same dimensions for element-wise operations.")
 
+        # Numpy copies of the inputs, converted once and reused by all fitting steps.
+        # Counts are stored as int32 whenever they fit, to halve memory traffic.
+        counts_dtype = (
+            np.int32
+            if self.data["counts"].values.max() <= np.iinfo(np.int32).max
+            else np.int64
+        )
+        self._counts_np = np.ascontiguousarray(self.data["counts"].values, dtype=counts_dtype)
+        self._cnv_np = np.ascontiguousarray(self.data["cnv"].values, dtype=np.float32)
+        self._nz_per_gene = np.count_nonzero(self._counts_np, axis=0)
+        self._log_counts = None
+
         # Test counts before going further
         test_valid_counts(counts)
 
@@ -183,11 +203,12 @@ class deconveil_fit:
         )
         
         self.obsm={}
-        self.obsm["design_matrix"] = self.design_matrix 
+        self._set_design_matrix(self.design_matrix)
         self.min_mu = min_mu
         self.min_disp = min_disp
         self.n_obs=self.data["counts"].shape[0]
         self.n_vars=self.data["counts"].shape[1]
+        self._gene_flags = np.zeros(self.n_vars, dtype=np.uint8)
         self.var_names=self.data["counts"].columns
         self.max_disp = np.maximum(max_disp, self.n_obs)
         self.refit_cooks = refit_cooks
@@ -277,8 +298,10 @@ class deconveil_fit:
         else:
             # Reduce the design matrix to an intercept and reconstruct at the end
             self.obsm["design_matrix_buffer"] = self.obsm["design_matrix"].copy()
-            self.obsm["design_matrix"] = pd.DataFrame(
-                1, index=self.obs_names, columns=[["intercept"]]
+            self._set_design_matrix(
+                pd.DataFrame(
+                    1, index=self.obsm["design_matrix"].index, columns=[["intercept"]]
+                )
             )
             # Fit the trend curve with an intercept design
             self.fit_genewise_dispersions(vst=True)
@@ -286,7 +309,7 @@ class deconveil_fit:
                 self._fit_parametric_dispersion_trend(vst=True)
 
             # Restore the design matrix and free buffer
-            self.obsm["design_matrix"] = self.obsm["design_matrix_buffer"].copy()
+            self._set_design_matrix(self.obsm["design_matrix_buffer"].copy())
             del self.obsm["design_matrix_buffer"]
             
         
@@ -330,31 +353,24 @@ class deconveil_fit:
                 raise RuntimeError("Fit the dispersion curve prior to applying VST.")
 
             a0, a1 = self.uns["vst_trend_coeffs"]
-            return np.log2(
-                (
-                    1
-                    + a1
-                    + 2 * a0 * normed_counts
-                    + 2 * np.sqrt(a0 * normed_counts * (1 + a1 + a0 * normed_counts))
-                )
-                / (4 * a0)
-            )
-            
+            vst_counts = utils_CNaware.vst_parametric(normed_counts, a0, a1)
+
         elif self.vst_fit_type == "mean":
             gene_dispersions = self.varm["vst_genewise_dispersions"]
             use_for_mean = gene_dispersions > 10 * self.min_disp
             mean_disp = trim_mean(gene_dispersions[use_for_mean], proportiontocut=0.001)
-            return (
-                2 * np.arcsinh(np.sqrt(mean_disp * normed_counts))
-                - np.log(mean_disp)
-                - np.log(4)
-            ) / np.log(2)
+            vst_counts = utils_CNaware.vst_mean(normed_counts, mean_disp)
         else:
             raise NotImplementedError(
                 f"Found fit_type '{self.vst_fit_type}'. Expected 'parametric' or 'mean'."
             )
-            
-    
+
+        if isinstance(normed_counts, pd.DataFrame):
+            return pd.DataFrame(
+                vst_counts, index=normed_counts.index, columns=normed_counts.columns
+            )
+        return vst_counts
+
     def deseq2(self, fit_type: Optional[Literal["parametric", "mean"]] = None) -> None:
         
         """Perform dispersion and log fold-change (LFC) estimation.
@@ -397,6 +413,20 @@ class deconveil_fit:
             # for genes that had outliers replaced
             self.refit()
 
+    @property
+    def _log_counts_pos(self) -> np.ndarray:
+        """Natural log of the counts, with ``-inf`` at zero counts.
+
+        Computed once in single precision and reused by size factor fitting.
+        """
+        if self._log_counts is None:
+            self._log_counts = np.log(
+                self._counts_np,
+                out=np.full_like(self._counts_np, -np.inf, dtype=np.float32),
+                where=self._counts_np > 0,
+            )
+        return self._log_counts
+
     def fit_size_factors(
         self,
         fit_type: Literal["ratio", "poscounts", "iterative"] = "ratio",
@@ -440,29 +470,30 @@ class deconveil_fit:
         elif fit_type == "poscounts":
 
             # Calculate logcounts for x > 0 and take the mean for each gene
-            log_counts = np.zeros_like(self.data["counts"], dtype=float)
-            np.log(self.data["counts"], out=log_counts, where=self.data["counts"] != 0)
-            logmeans = log_counts.mean(0)
+            zero_counts = self._counts_np == 0
+            log_counts = self._log_counts_pos.copy()
+            log_counts[zero_counts] = 0
+            logmeans = log_counts.mean(0, dtype=float)
 
             # Determine which genes are usable (finite logmeans)
             self.filtered_genes = (~np.isinf(logmeans)) & (logmeans > 0)
             _control_mask &= self.filtered_genes
 
-            # Calculate size factor per sample
-            def sizeFactor(x):
-                _mask = np.logical_and(_control_mask, x > 0)
-                return np.exp(np.median(np.log(x[_mask]) - logmeans[_mask]))
-
-            sf = np.apply_along_axis(sizeFactor, 1, self.data["counts"])
-            del log_counts
+            # Calculate size factor per sample, as the median log-ratio over usable
+            # genes with positive counts (computed in place in log_counts)
+            log_counts -= logmeans
+            zero_counts |= ~_control_mask
+            log_counts[zero_counts] = np.nan
+            sf = np.exp(np.nanmedian(log_counts, axis=1))
+            del log_counts, zero_counts
 
             # Normalize size factors to a geometric mean of 1 to match DESeq
             self.obsm["size_factors"] = sf / (np.exp(np.mean(np.log(sf))))
-            self.layers["normed_counts"] = self.data["counts"] / self.obsm["size_factors"][:, None]
+            self.layers["normed_counts"] = self._normalize_counts()
             self.logmeans = logmeans
 
         # Test whether it is possible to use median-of-ratios.
-        elif (self.data["counts"] == 0).any().all():
+        elif (self._nz_per_gene < self.n_obs).all():
             # There is at least a zero for each gene
             warnings.warn(
                 "Every gene contains at least one zero, "
@@ -473,16 +504,22 @@ class deconveil_fit:
             self._fit_iterate_size_factors()
 
         else:
-            self.logmeans, self.filtered_genes = deseq2_norm_fit(self.data["counts"])
+            # Median-of-ratios, as in deseq2_norm_fit / deseq2_norm_transform, but
+            # reusing the cached log counts
+            log_counts = self._log_counts_pos
+            self.logmeans = log_counts.mean(0, dtype=float)
+            self.filtered_genes = ~np.isinf(self.logmeans)
             _control_mask &= self.filtered_genes
 
-            (
-                self.layers["normed_counts"],
-                self.obsm["size_factors"],
-            ) = deseq2_norm_transform(self.data["counts"], self.logmeans, _control_mask)
+            log_ratios = log_counts[:, _control_mask] - self.logmeans[_control_mask]
+            self.obsm["size_factors"] = np.exp(np.median(log_ratios, axis=1))
+            self.layers["normed_counts"] = self._normalize_counts()
 
         end = time.time()
-        self.varm["_normed_means"] = self.layers["normed_counts"].mean(0)
+        self.varm["_normed_means"] = pd.Series(
+            normed_means(self._counts_np, self.obsm["size_factors"]),
+            index=self.var_names,
+        )
 
         if not self.quiet:
             print(f"... done in {end - start:.2f} seconds.\n", file=sys.stderr)
@@ -506,9 +543,14 @@ class deconveil_fit:
             self.fit_size_factors()
             
         # Exclude genes with all zeroes
-        self.varm["non_zero"] = ~(self.data["counts"] == 0).all(axis=0)
+        self._set_gene_flag(_NON_ZERO, self._nz_per_gene > 0)
+        self.varm["non_zero"] = self._gene_flag(_NON_ZERO)
         self.non_zero_idx = np.arange(self.n_vars)[self.varm["non_zero"]]
         self.non_zero_genes = self.var_names[self.varm["non_zero"]]
+        # Plain numpy labels, for internal use on hot paths
+        self._non_zero_gene_names = self.var_names.to_numpy()[self.non_zero_idx]
+        self._counts_nz = self._counts_np[:, self.non_zero_idx]
+        self._cnv_nz = self._cnv_np[:, self.non_zero_idx]
 
         #if isinstance(self.non_zero_genes, pd.MultiIndex):
             #raise ValueError("non_zero_genes should not be a MultiIndex")
@@ -516,26 +558,21 @@ class deconveil_fit:
         # Fit "method of moments" dispersion estimates
         self._fit_MoM_dispersions()
 
-        # Convert to numpy for speed
-        design_matrix = self.obsm["design_matrix"].values
-        counts=self.data["counts"].to_numpy()
-        cnv=self.data["cnv"].to_numpy()
-       
+        # Cached numpy form of the design matrix
+        design_matrix = self._design_np
+
          # with a GLM (using rough dispersion estimates).
-        if (
-            len(self.obsm["design_matrix"].value_counts())
-            == self.obsm["design_matrix"].shape[-1]
-        ):
+        if self._design_is_saturated:
             mu_hat_ = self.inference.lin_reg_mu(
-                counts=counts[:, self.non_zero_idx],
+                counts=self._counts_nz,
                 size_factors=self.obsm["size_factors"],
                 design_matrix=design_matrix,
                 min_mu=self.min_mu,
             )
         else:
             _, mu_hat_, _, _ = self.inference.irls_glm(
-                counts=counts[:, self.non_zero_idx],
-                cnv=cnv[:, self.non_zero_idx],
+                counts=self._counts_nz,
+                cnv=self._cnv_nz,
                 size_factors=self.obsm["size_factors"],
                 design_matrix=design_matrix,
                 disp=self.varm["_MoM_dispersions"][self.non_zero_idx],
@@ -545,14 +582,13 @@ class deconveil_fit:
         mu_param_name = "_vst_mu_hat" if vst else "_mu_hat"
         disp_param_name = "genewise_dispersions"
 
-        self.layers[mu_param_name] = np.full((self.n_obs, self.n_vars), np.nan)
-        self.layers[mu_param_name][:, self.varm["non_zero"]] = mu_hat_
+        self._set_gene_layer(mu_param_name, mu_hat_)
 
         if not self.quiet:
             print("Fitting dispersions...", file=sys.stderr)
         start = time.time()
         dispersions_, l_bfgs_b_converged_ = self.inference.alpha_mle(
-            counts=counts[:, self.non_zero_idx],
+            counts=self._counts_nz,
             design_matrix=design_matrix,
             mu=self.layers[mu_param_name][:, self.non_zero_idx],
             alpha_hat=self.varm["_MoM_dispersions"][self.non_zero_idx],
@@ -572,6 +608,9 @@ class deconveil_fit:
         self.varm["_genewise_converged"] = np.full(self.n_vars, np.nan)
         self.varm["_genewise_converged"][self.varm["non_zero"]] = l_bfgs_b_converged_
 
+        # Log dispersions, reused by the dispersion prior
+        self.varm["_log_genewise"] = np.log(self.varm[disp_param_name])
+
 
     def fit_dispersion_trend(self, vst: bool = False) -> None:
         
@@ -604,6 +643,7 @@ class deconveil_fit:
                 f"Expected 'parametric' or 'mean' trend curve fit "
                 f"types, received {fit_type}"
             )
+        self.varm["_log_fitted"] = np.log(self.varm["fitted_dispersions"])
         end = time.time()
 
         if not self.quiet:
@@ -645,19 +685,17 @@ class deconveil_fit:
             )
          
         # Fit dispersions to the curve, and compute log residuals
-        gene_labels = self.non_zero_genes.to_numpy()
-        position_map = {label: idx for idx, label in enumerate(gene_labels)}
-        gene_index = self.non_zero_genes.map(lambda x: position_map[x])
-        
-        disp_residuals = np.log(
-            self.varm["genewise_dispersions"][gene_index]
-        ) - np.log(self.varm["fitted_dispersions"][gene_index])
+        nz = self.non_zero_idx
+
+        disp_residuals = self.varm["_log_genewise"][nz] - self.varm["_log_fitted"][nz]
 
         # Compute squared log-residuals and prior variance based on genes whose
         # dispersions are above 100 * min_disp. This is to reproduce DESeq2's behaviour.
-        above_min_disp = self.varm["genewise_dispersions"][gene_index] >= (
-            100 * self.min_disp
+        self._set_gene_flag(
+            _ABOVE_MIN_DISP,
+            self.varm["genewise_dispersions"] >= 100 * self.min_disp,
         )
+        above_min_disp = self._gene_flag(_ABOVE_MIN_DISP)[nz]
 
         self.uns["_squared_logres"] = (
             mean_absolute_deviation(disp_residuals[above_min_disp]) ** 2
@@ -678,15 +716,14 @@ class deconveil_fit:
         if "prior_disp_var" not in self.uns:
             self.fit_dispersion_prior()
         
-        # Convert to numpy for speed
-        design_matrix = self.obsm["design_matrix"].values
-        counts=self.data["counts"].to_numpy()
+        # Cached numpy form of the design matrix
+        design_matrix = self._design_np
 
         if not self.quiet:
             print("Fitting MAP dispersions...", file=sys.stderr)
         start = time.time()
         dispersions_, l_bfgs_b_converged_ = self.inference.alpha_mle(
-            counts=counts[:, self.non_zero_idx],
+            counts=self._counts_nz,
             design_matrix=design_matrix,
             mu=self.layers["_mu_hat"][:, self.non_zero_idx],
             alpha_hat=self.varm["fitted_dispersions"][self.non_zero_idx],
@@ -711,9 +748,15 @@ class deconveil_fit:
 
         # Filter outlier genes for which we won't apply shrinkage
         self.varm["dispersions"] = self.varm["MAP_dispersions"].copy()
-        self.varm["_outlier_genes"] = np.log(self.varm["genewise_dispersions"]) > np.log(
-            self.varm["fitted_dispersions"]
-        ) + 2 * np.sqrt(self.uns["_squared_logres"])
+        # log(gw) > log(fitted) + 2 * sqrt(squared_logres), with the scalar threshold
+        # moved out of the log domain
+        outlier_factor = np.exp(2 * np.sqrt(self.uns["_squared_logres"]))
+        self._set_gene_flag(
+            _OUTLIER,
+            self.varm["genewise_dispersions"]
+            > self.varm["fitted_dispersions"] * outlier_factor,
+        )
+        self.varm["_outlier_genes"] = self._gene_flag(_OUTLIER)
 
         self.varm["dispersions"][self.varm["_outlier_genes"]] = self.varm["genewise_dispersions"][
         self.varm["_outlier_genes"]
@@ -731,44 +774,45 @@ class deconveil_fit:
         if "dispersions" not in self.varm:
             self.fit_MAP_dispersions()
             
-         # Convert to numpy for speed
-        design_matrix = self.obsm["design_matrix"].values
-        counts=self.data["counts"].to_numpy()
-        cnv=self.data["cnv"].to_numpy()
-        cnv = cnv / 2
-        cnv = cnv + 0.1
+         # Cached numpy form of the design matrix
+        design_matrix = self._design_np
+        cnv = self._cnv_nz.astype(float)
+        cnv /= 2
+        cnv += 0.1
+
+        # Warm-start IRLS from previously fitted LFCs, if any
+        beta_init = None
+        if "LFC" in self.varm:
+            beta_init = self.varm["LFC"].to_numpy()[self.non_zero_idx]
+            if not np.isfinite(beta_init).all():
+                beta_init = None
 
         if not self.quiet:
             print("Fitting LFCs...", file=sys.stderr)
         start = time.time()
         mle_lfcs_, mu_, hat_diagonals_, converged_ = self.inference.irls_glm(
-            counts=counts[:, self.non_zero_idx],
-            cnv=cnv[:, self.non_zero_idx],
+            counts=self._counts_nz,
+            cnv=cnv,
             size_factors=self.obsm["size_factors"],
             design_matrix=design_matrix,
             disp=self.varm["dispersions"][self.non_zero_idx],
             min_mu=self.min_mu,
             beta_tol=self.beta_tol,
+            beta_init=beta_init,
         )
         end = time.time()
 
         if not self.quiet:
             print(f"... done in {end-start:.2f} seconds.\n", file=sys.stderr)
 
+        lfc = np.full((self.n_vars, design_matrix.shape[-1]), np.nan)
+        lfc[self.non_zero_idx] = mle_lfcs_
         self.varm["LFC"] = pd.DataFrame(
-            np.nan,
+            lfc,
             index=self.var_names,
             columns=self.obsm["design_matrix"].columns,
         )
 
-        self.varm["LFC"].update(
-            pd.DataFrame(
-                mle_lfcs_,
-                index=self.non_zero_genes,
-                columns=self.obsm["design_matrix"].columns,
-            )
-        )
-
         self.obsm["_mu_LFC"] = mu_
         self.obsm["_hat_diagonals"] = hat_diagonals_
 
@@ -791,45 +835,27 @@ class deconveil_fit:
         start = time.time()
         num_vars = self.obsm["design_matrix"].shape[-1]
 
-        #self.layers["normed_counts"] = self.layers["normed_counts"].to_numpy()
-        non_zero_mask = self.varm["non_zero"].to_numpy()
-        self.layers["normed_counts"] = self.layers["normed_counts"].to_numpy()
-        
+        non_zero_mask = self.varm["non_zero"]
+
         # Calculate dispersion
         dispersions = robust_method_of_moments_disp(
             self.layers["normed_counts"][:, non_zero_mask],
             self.obsm["design_matrix"],
         )
 
-        self.data["counts"] = self.data["counts"].to_numpy()
-        
-        # Calculate the squared pearson residuals for non-zero features
-        squared_pearson_res = self.data["counts"][:, non_zero_mask] - self.obsm["_mu_LFC"]
-        squared_pearson_res **= 2
-
-        # Calculate the overdispersion parameter tau
-        V = self.obsm["_mu_LFC"] ** 2
-        V *= dispersions[None, :]
-        V += self.obsm["_mu_LFC"]
-
-        # Calculate r^2 / (tau * num_vars)
-        squared_pearson_res /= V
-        squared_pearson_res /= num_vars
-
-        del V
-
-        # Calculate leverage modifier H / (1 - H)^2
-        diag_mul = 1 - self.obsm["_hat_diagonals"]
-        diag_mul **= 2
-        diag_mul = self.obsm["_hat_diagonals"] / diag_mul
-
-        # Multiply r^2 / (tau * num_vars) by H / (1 - H)^2 to get cook's distance
-        squared_pearson_res *= diag_mul
-
-        del diag_mul
-
-        self.layers["cooks"] = np.full((self.n_obs, self.n_vars), np.nan)
-        self.layers["cooks"][:, non_zero_mask] = squared_pearson_res
+        # Downstream steps (outlier replacement, results) index counts as an array
+        self.data["counts"] = self._counts_np
+
+        # r^2 / (tau * num_vars) * H / (1 - H)^2, with r the pearson residuals of the
+        # non-zero features, computed in one pass
+        cooks = cooks_distances(
+            self._counts_nz,
+            self.obsm["_mu_LFC"],
+            dispersions,
+            self.obsm["_hat_diagonals"],
+            num_vars,
+        )
+        self._set_gene_layer("cooks", cooks)
 
         if not self.quiet:
             print(f"... done in {time.time()-start:.2f} seconds.\n", file=sys.stderr)
@@ -844,11 +870,11 @@ class deconveil_fit:
         self._replace_outliers()
         if not self.quiet:
             print(
-                f"Replacing {sum(self.varm['replaced']) } outlier genes.\n",
+                f"Replacing {self.varm['replaced'].sum()} outlier genes.\n",
                 file=sys.stderr,
             )
 
-        if sum(self.varm["replaced"]) > 0:
+        if self.varm["replaced"].any():
             # Refit dispersions and LFCs for genes that had outliers replaced
             self._refit_without_outliers()
         else:
@@ -859,6 +885,57 @@ class deconveil_fit:
             )
         
 
+    def _normalize_counts(self) -> np.ndarray:
+        """Counts divided by the size factors, as a single precision numpy array."""
+        # Divide in double precision and round once on output, without a float64 temp
+        return np.divide(
+            self._counts_np,
+            self.obsm["size_factors"][:, None],
+            out=np.empty(self._counts_np.shape, dtype=np.float32),
+            casting="unsafe",
+        )
+
+    def _set_gene_layer(
+        self, name: str, values: np.ndarray, dtype: type = np.float64
+    ) -> None:
+        """Store ``values`` for the non-zero genes in layer ``name``, NaN elsewhere.
+
+        The ``n_obs x n_vars`` buffer of an existing layer is reused when possible,
+        so refitting does not reallocate it.
+        """
+        layer = self.layers.get(name)
+        if (
+            not isinstance(layer, np.ndarray)
+            or layer.shape != (self.n_obs, self.n_vars)
+            or layer.dtype != dtype
+        ):
+            layer = np.empty((self.n_obs, self.n_vars), dtype=dtype)
+        layer[:, ~self.varm["non_zero"]] = np.nan
+        layer[:, self.non_zero_idx] = values
+        self.layers[name] = layer
+
+    def _set_design_matrix(self, design_matrix: pd.DataFrame) -> None:
+        """Set the design matrix used for fitting, along with its cached numpy form.
+
+        Also records whether the design is saturated, i.e. has as many distinct rows
+        as coefficients, in which case initial means are fitted by linear regression
+        rather than by a GLM.
+        """
+        self.obsm["design_matrix"] = design_matrix
+        self._design_np = np.ascontiguousarray(design_matrix.to_numpy(dtype=np.float64))
+        self._design_is_saturated = (
+            np.unique(self._design_np, axis=0).shape[0] == self._design_np.shape[-1]
+        )
+
+    def _set_gene_flag(self, flag: np.uint8, mask: np.ndarray) -> None:
+        """Set ``flag`` in the gene status bytes where ``mask`` holds, clear it elsewhere."""
+        self._gene_flags &= ~flag
+        self._gene_flags |= mask.astype(np.uint8) * flag
+
+    def _gene_flag(self, flag: np.uint8) -> np.ndarray:
+        """Boolean mask of the genes whose status byte has ``flag`` set."""
+        return (self._gene_flags & flag) != 0
+
     def _fit_MoM_dispersions(self) -> None:
         
         """Rough method of moments initial dispersions fit.
@@ -872,7 +949,7 @@ class deconveil_fit:
         normed_counts = self.layers["normed_counts"]
         rde = self.inference.fit_rough_dispersions(
             normed_counts,
-            self.obsm["design_matrix"].values,
+            self._design_np,
         )
         mde = self.inference.fit_moments_dispersions2(
             normed_counts, 
@@ -906,30 +983,23 @@ class deconveil_fit:
 
         #disp_param_name = "disp_param_name"
 
-        # Exclude all-zero counts
-        targets = pd.Series(
-            self.varm[disp_param_name][self.non_zero_idx].copy(),
-            index=self.non_zero_genes,
-        )
-        covariates = pd.Series(
-            1 / self.varm["_normed_means"][self.non_zero_idx],
-            index=self.non_zero_genes,
-        )
+        # Exclude all-zero counts and non-finite covariates. gene_idx holds the
+        # positions of the remaining genes in the full gene arrays.
+        inv_means = 1 / np.asarray(self.varm["_normed_means"])[self.non_zero_idx]
+        finite = np.isfinite(inv_means)
+        gene_idx = self.non_zero_idx[finite]
+        gene_names = self._non_zero_gene_names[finite]
 
-        for gene in self.non_zero_genes:
-            if (
-                np.isinf(covariates.loc[gene]).any()
-                or np.isnan(covariates.loc[gene]).any()
-            ):
-                targets.drop(labels=[gene], inplace=True)
-                covariates.drop(labels=[gene], inplace=True)
+        targets = pd.Series(self.varm[disp_param_name][gene_idx], index=gene_names)
+        covariates = pd.Series(inv_means[finite], index=gene_names)
 
         # Initialize coefficients
-        old_coeffs = pd.Series([0.1, 0.1])
-        coeffs = pd.Series([1.0, 1.0])
-        while (coeffs > 1e-10).all() and (
-            np.log(np.abs(coeffs / old_coeffs)) ** 2
-        ).sum() >= 1e-6:
+        old_coeffs = np.array([0.1, 0.1])
+        coeffs = np.array([1.0, 1.0])
+        while (
+            coeffs.min() > 1e-10
+            and np.sum(np.log(np.abs(coeffs / old_coeffs)) ** 2) >= 1e-6
+        ):
             old_coeffs = coeffs
             coeffs, predictions, converged = self.inference.dispersion_trend_gamma_glm(
                 covariates, targets
@@ -947,21 +1017,11 @@ class deconveil_fit:
                 return
 
             # Filter out genes that are too far away from the curve before refitting
-            gene_labels = self.non_zero_genes.to_numpy()
-            position_map = {label: idx for idx, label in enumerate(gene_labels)}
-            covariates_index = covariates.index.map(lambda x: position_map[x])
-            
-            
-            pred_ratios = self.varm[disp_param_name][covariates_index] / predictions
-
-            targets.drop(
-                targets[(pred_ratios < 1e-4) | (pred_ratios >= 15)].index,
-                inplace=True,
-            )
-            covariates.drop(
-                covariates[(pred_ratios < 1e-4) | (pred_ratios >= 15)].index,
-                inplace=True,
-            )
+            pred_ratios = self.varm[disp_param_name][gene_idx] / predictions
+            keep = (pred_ratios >= 1e-4) & (pred_ratios < 15)
+            gene_idx = gene_idx[keep]
+            targets = targets[keep]
+            covariates = covariates[keep]
 
         if vst:
             self.uns["vst_trend_coeffs"] = pd.Series(coeffs, index=["a0", "a1"])
@@ -1017,56 +1077,31 @@ class deconveil_fit:
             )
             return
 
-        # Get positions of counts with cooks above threshold
-        cooks_cutoff = f.ppf(0.99, num_vars, num_samples - num_vars)
-        idx = self.layers["cooks"] > cooks_cutoff
-        self.varm["replaced"] = idx.any(axis=0)
+        # Flag genes whose largest Cook's distance is above threshold. fmax skips
+        # the NaN columns of all-zero genes, which are never flagged.
+        cooks_cutoff = utils_CNaware.cooks_cutoff(num_vars, num_samples)
+        self.varm["replaced"] = np.fmax.reduce(self.layers["cooks"], axis=0) > cooks_cutoff
 
-        if sum(self.varm["replaced"] > 0):
+        if self.varm["replaced"].any():
             # Compute replacement counts: trimmed means * size_factors
+            counts_to_refit = self._counts_np[:, self.varm["replaced"]]
+            size_factors = self.obsm["size_factors"][:, None]
 
-            self.counts_to_refit = pd.DataFrame(
-                self.data["counts"][:, self.varm["replaced"]], 
-                columns=self.var_names[self.varm["replaced"]]
+            trim_base_mean = trimmed_mean_cols(counts_to_refit / size_factors, trim=0.2)
+            replacement_counts = (trim_base_mean[None, :] * size_factors).astype(
+                counts_to_refit.dtype
             )
 
-            trim_base_mean = pd.DataFrame(
-                cast(
-                    np.ndarray,
-                    trimmed_mean(
-                        self.counts_to_refit / self.obsm["size_factors"][:, None],
-                        trim=0.2,
-                        axis=0,
-                    ),
-                ),
-                index=self.counts_to_refit.columns  # Use .columns instead of .var_names
-            )
+            # Replace the outlier counts of samples that can be replaced
+            replace_mask = self.layers["cooks"][:, self.varm["replaced"]] > cooks_cutoff
+            replace_mask &= self.obsm["replaceable"][:, None]
+            np.copyto(counts_to_refit, replacement_counts, where=replace_mask)
 
-            replacement_counts = (
-                pd.DataFrame(
-                    (trim_base_mean.values * self.obsm["size_factors"]).T,  # Ensure this is 2D
-                    index=self.counts_to_refit.index, 
-                    columns=self.counts_to_refit.columns  
-                )
-                .astype(int)
+            self.counts_to_refit = pd.DataFrame(
+                counts_to_refit,
+                columns=self.var_names[self.varm["replaced"]],
             )
 
-            replace_mask = self.obsm["replaceable"][:, None] & idx[:, self.varm["replaced"]]
-            
-            print(f"replace_mask before filtering: {replace_mask.shape}")
-            print(f"Number of True values in replace_mask: {np.sum(replace_mask)}")
-
-            # Ensure that replacement_counts and the indexing result are compatible
-            replacement_counts_trimmed = replacement_counts.loc[replace_mask.any(axis=1)] 
-            print(f"replacement_counts_trimmed shape: {replacement_counts_trimmed.shape}")
-
-            # Apply the mask to refit only the matching rows, ensuring consistent dimensions
-            assert replacement_counts_trimmed.shape == self.counts_to_refit.loc[replace_mask.any(axis=1)].shape, \
-                f"Shape mismatch: replacement_counts_trimmed {replacement_counts_trimmed.shape} vs refit slice  {self.counts_to_refit.loc[replace_mask.any(axis=1)].shape}"
-
-            # Replace counts in self.counts_to_refit for the rows matching the mask
-            self.counts_to_refit.loc[replace_mask.any(axis=1)] = replacement_counts_trimmed.values
-
 
     def _refit_without_outliers(
         self,
@@ -1081,7 +1116,7 @@ class deconveil_fit:
             self._replace_outliers()
 
         # Only refit genes for which replacing outliers hasn't resulted in all zeroes
-        new_all_zeroes = (self.counts_to_refit == 0).all(axis=0)
+        new_all_zeroes = ~self.counts_to_refit.to_numpy().any(axis=0)
         self.new_all_zeroes_genes = self.counts_to_refit.columns[new_all_zeroes]
 
         self.varm["refitted"] = self.varm["replaced"].copy()
@@ -1124,9 +1159,7 @@ class deconveil_fit:
 
         # Use the same size factors
         sub_dds.obsm["size_factors"] = self.obsm["size_factors"]
-        sub_dds.layers["normed_counts"] = (
-            sub_dds.data["counts"] / sub_dds.obsm["size_factors"][:, None]
-        )
+        sub_dds.layers["normed_counts"] = sub_dds._normalize_counts()
 
         # Estimate gene-wise dispersions.
         sub_dds.fit_genewise_dispersions()
@@ -1138,7 +1171,10 @@ class deconveil_fit:
             sub_dds.uns["trend_coeffs"] = self.uns["trend_coeffs"]
         elif sub_dds.uns["disp_function_type"] == "mean":
             sub_dds.uns["mean_disp"] = self.uns["mean_disp"]
-        sub_dds.varm["_normed_means"] = sub_dds.layers["normed_counts"].mean(0)
+        sub_dds.varm["_normed_means"] = pd.Series(
+            normed_means(sub_dds._counts_np, sub_dds.obsm["size_factors"]),
+            index=sub_dds.var_names,
+        )
         # Reshape in case there's a single gene to refit
         sub_dds.varm["fitted_dispersions"] = sub_dds.disp_function(
             sub_dds.varm["_normed_means"]
@@ -1151,7 +1187,9 @@ class deconveil_fit:
 
         sub_dds.fit_MAP_dispersions()
 
-        # Estimate log-fold changes (in natural log scale)
+        # Estimate log-fold changes (in natural log scale), starting from the fit
+        # with outliers
+        sub_dds.varm["LFC"] = self.varm["LFC"][self.varm["refitted"]]
         sub_dds.fit_LFC()
 
         # Replace values in main object
@@ -1163,10 +1201,14 @@ class deconveil_fit:
         self.varm["fitted_dispersions"][self.varm["refitted"]] = sub_dds.varm[
             "fitted_dispersions"
         ]
+        self.varm["_log_genewise"][self.varm["refitted"]] = sub_dds.varm["_log_genewise"]
+        self.varm["_log_fitted"][self.varm["refitted"]] = np.log(
+            sub_dds.varm["fitted_dispersions"]
+        )
         self.varm["dispersions"][self.varm["refitted"]] = sub_dds.varm["dispersions"]
 
-        replace_cooks = pd.DataFrame(self.layers["cooks"].copy())
-        replace_cooks.loc[self.obsm["replaceable"], self.varm["refitted"]] = 0.0
+        replace_cooks = self.layers["cooks"].copy()
+        replace_cooks[np.ix_(self.obsm["replaceable"], self.varm["refitted"])] = 0.0
 
         self.layers["replace_cooks"] = replace_cooks
         
@@ -1193,34 +1235,22 @@ class deconveil_fit:
 
         # Reduce the design matrix to an intercept and reconstruct at the end
         self.obsm["design_matrix_buffer"] = self.obsm["design_matrix"].copy()
-        self.obsm["design_matrix"] = pd.DataFrame(
-            1, index=self.obs_names, columns=["intercept"]
-        )
-
-        # Fit size factors using MLE
-        def objective(p):
-            sf = np.exp(p - np.mean(p))
-            nll = nb_nll(
-                counts=self[:, self.non_zero_genes].data["counts"],
-                mu=self[:, self.non_zero_genes].layers["_mu_hat"]
-                / self.obsm["size_factors"][:, None]
-                * sf[:, None],
-                alpha=self[:, self.non_zero_genes].varm["dispersions"],
+        self._set_design_matrix(
+            pd.DataFrame(
+                1, index=self.obsm["design_matrix"].index, columns=["intercept"]
             )
-            # Take out the lowest likelihoods (highest neg) from the sum
-            return np.sum(nll[nll < np.quantile(nll, quant)])
+        )
 
         for i in range(niter):
             # Estimate dispersions based on current size factors
             self.fit_genewise_dispersions()
 
             # Use a mean trend curve
-            use_for_mean_genes = self.var_names[
-                (self.varm["genewise_dispersions"] > 10 * self.min_disp)
-                & self.varm["non_zero"]
-            ]
+            use_for_mean = (
+                self.varm["genewise_dispersions"] > 10 * self.min_disp
+            ) & self.varm["non_zero"]
 
-            if len(use_for_mean_genes) == 0:
+            if not use_for_mean.any():
                 print(
                     "No genes have a dispersion above 10 * min_disp in "
                     "_fit_iterate_size_factors."
@@ -1228,17 +1258,30 @@ class deconveil_fit:
                 break
 
             mean_disp = trim_mean(
-                self[:, use_for_mean_genes].varm["genewise_dispersions"],
+                self.varm["genewise_dispersions"][use_for_mean],
                 proportiontocut=0.001,
             )
 
             self.varm["fitted_dispersions"] = np.ones(self.n_vars) * mean_disp
+            self.varm["_log_fitted"] = np.full(self.n_vars, np.log(mean_disp))
             self.fit_dispersion_prior()
             self.fit_MAP_dispersions()
             old_sf = self.obsm["size_factors"].copy()
 
-            # Fit size factors using MLE
-            res = minimize(objective, np.log(old_sf), method="Powell")
+            # Fit size factors using MLE, with the means of the non-zero genes
+            # rescaled to unit size factors
+            res = minimize(
+                trimmed_sf_nll,
+                np.log(old_sf),
+                args=(
+                    self._counts_nz,
+                    self.layers["_mu_hat"][:, self.non_zero_idx] / old_sf[:, None],
+                    self.varm["dispersions"][self.non_zero_idx],
+                    quant,
+                ),
+                jac=True,
+                method="L-BFGS-B",
+            )
 
             self.obsm["size_factors"] = np.exp(res.x - np.mean(res.x))
 
@@ -1254,17 +1297,17 @@ class deconveil_fit:
                 print("Iterative size factor fitting did not converge.", file=sys.stderr)
 
         # Restore the design matrix and free buffer
-        self.obsm["design_matrix"] = self.obsm["design_matrix_buffer"].copy()
+        self._set_design_matrix(self.obsm["design_matrix_buffer"].copy())
         del self.obsm["design_matrix_buffer"]
 
         # Store normalized counts
-        self.layers["normed_counts"] = self.data["counts"] / self.obsm["size_factors"][:, None]
+        self.layers["normed_counts"] = self._normalize_counts()
 
     
     def _check_full_rank_design(self):
         """Check that the design matrix has full column rank."""
-        rank = np.linalg.matrix_rank(self.obsm["design_matrix"])
-        num_vars = self.obsm["design_matrix"].shape[1]
+        rank = utils_CNaware.prepare_design(self._design_np).rank
+        num_vars = self._design_np.shape[1]
 
         if rank < num_vars:
             warnings.warn(
@@ -7,6 +7,8 @@ import pandas as pd
 from joblib import Parallel  # type: ignore
 from joblib import delayed
 from joblib import parallel_backend
+from numba import config  # type: ignore
+from numba import set_num_threads  # type: ignore
 from scipy.optimize import minimize  # type: ignore
 
 from deconveil import inference
@@ -103,37 +105,25 @@ class DefInference(inference.Inference):
         max_beta: float = 30,
         optimizer: Literal["BFGS", "L-BFGS-B"] = "L-BFGS-B",
         maxiter: int = 250,
+        beta_init: Optional[np.ndarray] = None,
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-        with parallel_backend(self._backend, inner_max_num_threads=1):
-            res = Parallel(
-                n_jobs=self.n_cpus,
-                verbose=self._joblib_verbosity,
-                batch_size=self._batch_size,
-            )(
-                delayed(utils_CNaware.irls_glm)(
-                    counts=counts[:, i],
-                    size_factors=size_factors,
-                    design_matrix=design_matrix,
-                    disp=disp[i],
-                    cnv=cnv[:, i],
-                    min_mu=min_mu,
-                    beta_tol=beta_tol,
-                    min_beta=min_beta,
-                    max_beta=max_beta,
-                    optimizer=optimizer,
-                    maxiter=maxiter,
-                )
-                for i in range(counts.shape[1])
-            )
-        res = zip(*res)
-        MLE_lfcs_, mu_hat_, hat_diagonals_, converged_ = (np.array(m) for m in res)
-
-        return (
-            MLE_lfcs_,
-            mu_hat_.T,
-            hat_diagonals_.T,
-            converged_,
+        # Genes are fitted in parallel threads within the compiled IRLS kernels
+        set_num_threads(min(self.n_cpus, config.NUMBA_NUM_THREADS))
+        return utils_CNaware.irls_glm_batch(
+            counts=counts,
+            size_factors=size_factors,
+            design_matrix=design_matrix,
+            disp=disp,
+            cnv=cnv,
+            min_mu=min_mu,
+            beta_tol=beta_tol,
+            min_beta=min_beta,
+            max_beta=max_beta,
+            optimizer=optimizer,
+            maxiter=maxiter,
+            beta_init=beta_init,
         )
+
     def alpha_mle(  # noqa: D102
         self,
         counts: np.ndarray,
@@ -147,6 +137,21 @@ class DefInference(inference.Inference):
         prior_reg: bool = False,
         optimizer: Literal["BFGS", "L-BFGS-B"] = "L-BFGS-B",
     ) -> Tuple[np.ndarray, np.ndarray]:
+        if optimizer == "L-BFGS-B":
+            # Bounded fits run in parallel threads within a compiled kernel
+            set_num_threads(min(self.n_cpus, config.NUMBA_NUM_THREADS))
+            return utils_CNaware.alpha_mle_batch(
+                counts=counts,
+                design_matrix=design_matrix,
+                mu=mu,
+                alpha_hat=alpha_hat,
+                min_disp=min_disp,
+                max_disp=max_disp,
+                prior_disp_var=prior_disp_var,
+                cr_reg=cr_reg,
+                prior_reg=prior_reg,
+            )
+
         with parallel_backend(self._backend, inner_max_num_threads=1):
             res = Parallel(
                 n_jobs=self.n_cpus,
@@ -175,26 +180,24 @@ class DefInference(inference.Inference):
     def dispersion_trend_gamma_glm(  # noqa: D102
         self, covariates: pd.Series, targets: pd.Series
     ) -> Tuple[np.ndarray, np.ndarray, bool]:
-        covariates_w_intercept = covariates.to_frame()
-        covariates_w_intercept.insert(0, "intercept", 1)
-        covariates_fit = covariates_w_intercept.values
-        targets_fit = targets.values
-
-        def loss(coeffs):
-            mu = covariates_fit @ coeffs
-            return np.nanmean(targets_fit / mu + np.log(mu), axis=0)
+        covariates_fit = np.column_stack(
+            [np.ones(len(covariates)), covariates.to_numpy(dtype=float)]
+        )
+        targets_fit = targets.to_numpy(dtype=float)
 
-        def grad(coeffs):
+        def loss_and_grad(coeffs):
+            # The trend is evaluated once and shared by the loss and its gradient
             mu = covariates_fit @ coeffs
-            return -np.nanmean(
-                ((targets_fit / mu - 1)[:, None] * covariates_fit) / mu[:, None], axis=0
-            )
+            ratio = targets_fit / mu
+            loss = np.nanmean(ratio + np.log(mu), axis=0)
+            grad = -np.nanmean(((ratio - 1) / mu)[:, None] * covariates_fit, axis=0)
+            return loss, grad
 
         try:
             res = minimize(
-                loss,
+                loss_and_grad,
                 x0=np.array([1.0, 1.0]),
-                jac=grad,
+                jac=True,
                 method="L-BFGS-B",
                 bounds=[(1e-12, np.inf)],
             )
@@ -219,6 +222,8 @@ class DefInference(inference.Inference):
         ] = None,
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         num_genes = mu.shape[1]
+        # Row-major copy shared by all per-gene products with the design matrix
+        design_matrix = np.ascontiguousarray(design_matrix)
         with parallel_backend(self._backend, inner_max_num_threads=1):
             res = Parallel(
                 n_jobs=self.n_cpus,
@@ -255,6 +260,8 @@ class DefInference(inference.Inference):
         optimizer: str,
         shrink_index: int,
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Row-major copy shared by all per-gene products with the design matrix
+        design_matrix = np.ascontiguousarray(design_matrix)
         with parallel_backend(self._backend, inner_max_num_threads=1):
             num_genes = counts.shape[1]
             res = Parallel(
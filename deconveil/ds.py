@@ -7,9 +7,9 @@ from typing import Optional
 import numpy as np
 import pandas as pd
 from scipy.optimize import root_scalar  # type: ignore
-from scipy.stats import f  # type: ignore
 from scipy.stats import false_discovery_control  # type: ignore
 
+from deconveil import utils_CNaware
 from deconveil.dds import deconveil_fit
 from deconveil.default_inference import DefInference
 from deconveil.inference import Inference
@@ -532,7 +532,7 @@ class deconveil_stats:
 
         num_samples = self.dds.n_obs
         num_vars = self.design_matrix.shape[-1]
-        cooks_cutoff = f.ppf(0.99, num_vars, num_samples - num_vars)
+        cooks_cutoff = utils_CNaware.cooks_cutoff(num_vars, num_samples)
 
         # As in DESeq2, only take samples with 3 or more replicates when looking for
         # max cooks.
@@ -546,11 +546,9 @@ class deconveil_stats:
         
         if self.dds.refit_cooks and self.dds.varm["refitted"].sum() > 0:
             cooks_layer = self.dds.layers["replace_cooks"]
-            filtered_cooks_layer = cooks_layer.loc[use_for_max, :] 
-            
         else:
             cooks_layer = self.dds.layers["cooks"]
-            filtered_cooks_layer = cooks_layer[use_for_max, :] 
+        filtered_cooks_layer = cooks_layer[use_for_max, :]
 
         cooks_outlier = (filtered_cooks_layer > cooks_cutoff).any(axis=0).copy()
         
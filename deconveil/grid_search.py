@@ -1,7 +1,7 @@
 from typing import Optional
 
 import numpy as np
-from scipy.special import gammaln  # type: ignore
+from scipy.special import xlogy  # type: ignore
 
 from deconveil import utils_CNaware
 
@@ -53,25 +53,33 @@ def grid_fit_beta(
     ndarray
         Fitted LFC parameter.
     """
-    
+
     x_grid = np.linspace(min_beta, max_beta, grid_length)
     y_grid = np.linspace(min_beta, max_beta, grid_length)
-    ll_grid = np.zeros((grid_length, grid_length))
+    # The loss is kept in double precision: for small dispersions 1 / disp dwarfs
+    # the counts, which single precision cannot resolve
+    X = design_matrix.astype(float)
+    y = counts.astype(float)[:, None]
+    y_alpha = y + 1 / disp
+    cs = (cnv * size_factors)[:, None]
 
     def loss(beta: np.ndarray) -> np.ndarray:
-        # closure to minimize
-        print(f"Shape of beta: {beta.shape}")
-        print(f"Shape of design_matrix: {design_matrix.shape}")
-
-        if beta is None or len(beta.shape) < 2:
-            raise ValueError("Beta is not properly initialized or has an unexpected shape.")
-
-            
-        mu = np.maximum(cnv * size_factors[:, None] * np.exp(design_matrix @ beta.T), min_mu)
-        return vec_nb_nll(counts, mu, disp) + 0.5 * (1e-6 * beta**2).sum(1)
-
-    for i, x in enumerate(x_grid):
-        ll_grid[i, :] = loss(np.array([[x, y] for y in y_grid]))
+        # closure to minimize, evaluated on a whole grid of betas at once
+        mu = X @ beta.T
+        np.exp(mu, out=mu)
+        mu *= cs
+        np.maximum(mu, min_mu, out=mu)
+        # NB deviance, i.e. the negative log-likelihood up to a constant. The second
+        # term is written with log1p so that it tends to mu - y, rather than to a
+        # difference of two large numbers, as disp goes to 0.
+        dev = xlogy(y, y / mu) + y_alpha * np.log1p((mu - y) / y_alpha)
+        return dev.sum(0) + 0.5 * (1e-6 * beta**2).sum(1)
+
+    def grid(x_grid: np.ndarray, y_grid: np.ndarray) -> np.ndarray:
+        # All (x, y) pairs, with x varying along the first axis of the grid
+        return np.stack(np.meshgrid(x_grid, y_grid, indexing="ij"), -1).reshape(-1, 2)
+
+    ll_grid = loss(grid(x_grid, y_grid)).reshape(grid_length, grid_length)
 
     min_idxs = np.unravel_index(np.argmin(ll_grid, axis=None), ll_grid.shape)
     delta = x_grid[1] - x_grid[0]
@@ -86,8 +94,7 @@ def grid_fit_beta(
         grid_length,
     )
 
-    for i, x in enumerate(fine_x_grid):
-        ll_grid[i, :] = loss(np.array([[x, y] for y in fine_y_grid]))
+    ll_grid = loss(grid(fine_x_grid, fine_y_grid)).reshape(grid_length, grid_length)
 
     min_idxs = np.unravel_index(np.argmin(ll_grid, axis=None), ll_grid.shape)
     beta = np.array([fine_x_grid[min_idxs[0]], fine_y_grid[min_idxs[1]]])
@@ -58,6 +58,7 @@ class Inference(ABC):
         max_beta: float = 30,
         optimizer: Literal["BFGS", "L-BFGS-B"] = "L-BFGS-B",
         maxiter: int = 250,
+        beta_init: Optional[np.ndarray] = None,
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         r"""Fit a NB GLM wit log-link to predict counts from the design matrix.
 
@@ -82,9 +83,8 @@ class Inference(ABC):
             (default: ``0.5``).
 
         beta_tol : float
-            Stopping criterion for IRWLS:
-            :math:`\vert dev - dev_{old}\vert / \vert dev + 0.1 \vert < \beta_{tol}`.
-            (default: ``1e-8``).
+            Stopping criterion for IRWLS, on the relative change of the
+            coefficients. (default: ``1e-8``).
 
         min_beta : float
             Lower-bound on LFC. (default: ``-30``).
@@ -102,6 +102,11 @@ class Inference(ABC):
             Maximum number of IRLS iterations to perform before switching to L-BFGS-B.
             (default: ``250``).
 
+        beta_init : ndarray
+            Initial coefficients, one row per gene, e.g. from a previous fit of the
+            same genes. If ``None``, they are estimated from the data.
+            (default: ``None``).
+
         Returns
         -------
         beta: ndarray
@@ -1,11 +1,13 @@
 import os
-import multiprocessing
 import warnings
+from functools import lru_cache
 from math import ceil
 from math import floor
+from math import lgamma
 from pathlib import Path
 from typing import List
 from typing import Literal
+from typing import NamedTuple
 from typing import Optional
 from typing import Tuple
 from typing import Union
@@ -14,14 +16,19 @@ from typing import cast
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
-from scipy.linalg import solve  # type: ignore
+from scipy.linalg import qr  # type: ignore
+from scipy.linalg import solve_triangular  # type: ignore
+from scipy.linalg.blas import dsyrk  # type: ignore
 from scipy.optimize import minimize  # type: ignore
 from scipy.special import gammaln  # type: ignore
 from scipy.special import polygamma  # type: ignore
+from scipy.stats import f  # type: ignore
 from scipy.stats import norm  # type: ignore
 from sklearn.linear_model import LinearRegression  # type: ignore
 import matplotlib.pyplot as plt
 import seaborn as sns
+from numba import njit  # type: ignore
+from numba import prange  # type: ignore
 
 from deconveil.grid_search import grid_fit_beta
 
@@ -31,6 +38,46 @@ from pydeseq2.grid_search import grid_fit_alpha
 from pydeseq2.grid_search import grid_fit_shrink_beta
 
 
+class DesignFactors(NamedTuple):
+    """Gene-independent quantities derived from a design matrix, shared by IRLS fits."""
+
+    X: np.ndarray
+    rank: int
+    pinv: Optional[np.ndarray]
+
+
+def prepare_design(design_matrix: np.ndarray) -> DesignFactors:
+    """Factorize a design matrix once for all the genes it is used with.
+
+    The rank is read off a column-pivoted QR factorization, which is cheaper than
+    the SVD used by ``np.linalg.matrix_rank`` and reused for the pseudoinverse.
+
+    Parameters
+    ----------
+    design_matrix : ndarray
+        Design matrix.
+
+    Returns
+    -------
+    DesignFactors
+        The contiguous design matrix, its rank, and its pseudoinverse if it has full
+        column rank (else ``None``).
+    """
+    X = np.ascontiguousarray(design_matrix, dtype=float)
+    Q, R, piv = qr(X, mode="economic", pivoting=True, check_finite=False)
+    # Same default tolerance as np.linalg.matrix_rank, with |R_00| bounding the
+    # largest singular value
+    diag_R = np.abs(np.diag(R))
+    tol = diag_R[0] * max(X.shape) * np.finfo(float).eps if diag_R.size else 0.0
+    rank = int(np.sum(diag_R > tol))
+    pinv = None
+    if rank == X.shape[1]:
+        # X^+ = P R^{-1} Q^t, with P the column permutation
+        pinv = np.empty((X.shape[1], X.shape[0]))
+        pinv[piv] = solve_triangular(R, Q.T, check_finite=False)
+    return DesignFactors(X, rank, pinv)
+
+
 def irls_glm(
     counts: np.ndarray,
     cnv: np.ndarray,
@@ -43,92 +90,1065 @@ def irls_glm(
     max_beta: float = 30,
     optimizer: Literal["BFGS", "L-BFGS-B"] = "L-BFGS-B",
     maxiter: int = 250,
+    beta_init: Optional[np.ndarray] = None,
+    design: Optional[DesignFactors] = None,
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, bool]:
+    """Fit a CN-aware NB GLM with log-link for a single gene.
+
+    Thin wrapper around :func:`irls_glm_batch`.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Raw counts for a given gene.
+
+    cnv : ndarray
+        Copy number values for a given gene.
+
+    size_factors : ndarray
+        Sample-wise scaling factors (obtained from median-of-ratios).
+
+    design_matrix : ndarray
+        Design matrix.
+
+    disp : float
+        Gene-wise dispersion prior.
+
+    min_mu : float
+        Lower bound on estimated means. (default: ``0.5``).
+
+    beta_tol : float
+        Stopping criterion for IRWLS. (default: ``1e-8``).
+
+    min_beta : float
+        Lower-bound on LFC. (default: ``-30``).
+
+    max_beta : float
+        Upper-bound on LFC. (default: ``30``).
+
+    optimizer : str
+        Optimizing method to use in case IRLS starts diverging.
+        Accepted values: 'BFGS' or 'L-BFGS-B'. (default: ``'L-BFGS-B'``).
+
+    maxiter : int
+        Maximum number of IRLS iterations to perform before switching to L-BFGS-B.
+        (default: ``250``).
+
+    beta_init : ndarray or None
+        Initial coefficients, e.g. from a previous fit of the same gene. If
+        ``None``, they are estimated from the data. (default: ``None``).
+
+    design : DesignFactors or None
+        Precomputed factorization of ``design_matrix``, see :func:`prepare_design`.
+        Computed on the fly if ``None``. (default: ``None``).
+
+    Returns
+    -------
+    beta: ndarray
+        Fitted (basemean, lfc) coefficients of negative binomial GLM.
+
+    mu: ndarray
+        Means estimated from size factors, CN values and beta.
+
+    H: ndarray
+        Diagonal of the :math:`W^{1/2} X (X^t W X)^-1 X^t W^{1/2}` covariance matrix.
+
+    converged: bool
+        Whether IRLS or the optimizer converged.
+    """
+    beta, mu, H, converged = irls_glm_batch(
+        counts=counts[:, None],
+        cnv=cnv[:, None],
+        size_factors=size_factors,
+        design_matrix=design_matrix,
+        disp=np.atleast_1d(disp),
+        min_mu=min_mu,
+        beta_tol=beta_tol,
+        min_beta=min_beta,
+        max_beta=max_beta,
+        optimizer=optimizer,
+        maxiter=maxiter,
+        beta_init=None if beta_init is None else beta_init[None, :],
+        design=design,
+    )
+    return beta[0], mu[:, 0], H[:, 0], converged[0]
+
+
+def irls_glm_batch(
+    counts: np.ndarray,
+    cnv: np.ndarray,
+    size_factors: np.ndarray,
+    design_matrix: np.ndarray,
+    disp: np.ndarray,
+    min_mu: float = 0.5,
+    beta_tol: float = 1e-8,
+    min_beta: float = -30,
+    max_beta: float = 30,
+    optimizer: Literal["BFGS", "L-BFGS-B"] = "L-BFGS-B",
+    maxiter: int = 250,
+    beta_init: Optional[np.ndarray] = None,
+    design: Optional[DesignFactors] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Fit CN-aware NB GLMs with log-link for a batch of genes.
+
+    All genes share the design matrix, so the initial least-squares estimates are
+    obtained from a single product with its pseudoinverse. IRLS then runs for every gene in one
+    compiled call. Genes for which IRLS diverges are refitted with ``optimizer``.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Raw counts. Rows: samples, columns: genes.
+
+    cnv : ndarray
+        Copy number values. Rows: samples, columns: genes.
+
+    size_factors : ndarray
+        Sample-wise scaling factors (obtained from median-of-ratios).
+
+    design_matrix : ndarray
+        Design matrix.
+
+    disp : ndarray
+        Gene-wise dispersion priors.
+
+    min_mu : float
+        Lower bound on estimated means. (default: ``0.5``).
+
+    beta_tol : float
+        Stopping criterion for IRWLS. (default: ``1e-8``).
 
+    min_beta : float
+        Lower-bound on LFC. (default: ``-30``).
+
+    max_beta : float
+        Upper-bound on LFC. (default: ``30``).
+
+    optimizer : str
+        Optimizing method to use in case IRLS starts diverging.
+        Accepted values: 'BFGS' or 'L-BFGS-B'. (default: ``'L-BFGS-B'``).
+
+    maxiter : int
+        Maximum number of IRLS iterations to perform before switching to L-BFGS-B.
+        (default: ``250``).
+
+    beta_init : ndarray or None
+        Initial coefficients, one row per gene, e.g. from a previous fit of the
+        same genes. If ``None``, they are estimated by least squares on the log
+        normalized counts. (default: ``None``).
+
+    design : DesignFactors or None
+        Precomputed factorization of ``design_matrix``, see :func:`prepare_design`.
+        Computed on the fly if ``None`` and ``beta_init`` is not provided.
+        (default: ``None``).
+
+    Returns
+    -------
+    beta: ndarray
+        Fitted coefficients, one row per gene.
+
+    mu: ndarray
+        Estimated means. Rows: samples, columns: genes.
+
+    H: ndarray
+        Diagonals of the hat matrices. Rows: samples, columns: genes.
+
+    converged: ndarray
+        Whether IRLS or the optimizer converged for each gene.
+    """
     assert optimizer in ["BFGS", "L-BFGS-B"]
-    
-    num_vars = design_matrix.shape[1]
-    X = design_matrix
-    
-    # if full rank, estimate initial betas for IRLS below
-    if np.linalg.matrix_rank(X) == num_vars:
-        Q, R = np.linalg.qr(X)
-        y = np.log((counts / cnv) / size_factors + 0.1)
-        beta_init = solve(R, Q.T @ y)
-        beta = beta_init
-
-    else:  # Initialise intercept with log base mean
-        beta_init = np.zeros(num_vars)
-        beta_init[0] = np.log((counts / cnv) / size_factors).mean()
-        beta = beta_init
-        
+
+    # Products of copy numbers and size factors, shared by all IRLS steps
+    cs = cnv * size_factors[:, None]
+
+    if beta_init is not None:
+        # Warm start: the design matrix needs no factorization
+        X = (
+            design.X
+            if design is not None
+            else np.ascontiguousarray(design_matrix, dtype=float)
+        )
+        beta_init = np.array(beta_init, dtype=float)
+    else:
+        if design is None:
+            design = prepare_design(design_matrix)
+        X = design.X
+        normed_counts = counts / cs
+
+        # if full rank, estimate initial betas for IRLS below
+        if design.pinv is not None:
+            beta_init = (design.pinv @ np.log(normed_counts + 0.1)).T
+
+        else:  # Initialise intercept with log base mean
+            beta_init = np.zeros((counts.shape[1], X.shape[1]))
+            beta_init[:, 0] = np.log(normed_counts).mean(0)
+    num_vars = X.shape[1]
+
+    ridge_factor = 1e-6
+
+    # Genes are processed one at a time, so store them contiguously
+    counts_g = np.ascontiguousarray(counts.T, dtype=float)
+    cs_g = np.ascontiguousarray(cs.T, dtype=float)
+    disp = np.asarray(disp, dtype=float)
+
+    beta, mu, diverged = _irls_fit_genes(
+        counts_g,
+        cs_g,
+        X,
+        disp,
+        np.ascontiguousarray(beta_init),
+        ridge_factor,
+        min_mu,
+        beta_tol,
+        max_beta,
+        maxiter,
+    )
+    converged = np.ones(len(disp), dtype=bool)
+
+    # If IRLS starts diverging, use L-BFGS-B
+    for g in np.flatnonzero(diverged):
+        # Start from the least-squares estimates, unless they are not finite (e.g.
+        # for a null copy number)
+        x0 = beta_init[g] if np.isfinite(beta_init[g]).all() else np.zeros(num_vars)
+        res = minimize(
+            _nb_obj_grad,
+            x0,
+            args=(counts_g[g], cs_g[g], X, disp[g], min_mu, ridge_factor),
+            jac=True,
+            method=optimizer,
+            bounds=(
+                [(min_beta, max_beta)] * num_vars if optimizer == "L-BFGS-B" else None
+            ),
+        )
+
+        beta[g] = res.x
+        _fitted_mu(X, res.x, cs_g[g], min_mu, mu[g])
+        converged[g] = res.success
+
+    # Fits with non-finite coefficients, means or deviance are not usable
+    converged &= np.isfinite(beta).all(1)
+    converged &= np.isfinite(_nb_nll_genes(counts_g, mu, disp))
+
+    # Compute H diagonals (useful for Cook distance outlier filtering)
+    H = _hat_diagonals(X, mu, disp, ridge_factor)
+
+    return beta, mu.T, H.T, converged
+
+
+@njit(cache=True, error_model="numpy", parallel=True)
+def _irls_fit_genes(
+    counts: np.ndarray,
+    cs: np.ndarray,
+    X: np.ndarray,
+    disp: np.ndarray,
+    beta_init: np.ndarray,
+    ridge: float,
+    min_mu: float,
+    beta_tol: float,
+    max_beta: float,
+    maxiter: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Run IRLS for every gene of a batch, in parallel threads.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Raw counts. Rows: genes, columns: samples.
+
+    cs : ndarray
+        Products of copy number values and size factors. Rows: genes, columns:
+        samples.
+
+    X : ndarray
+        Design matrix.
+
+    disp : ndarray
+        Gene-wise dispersions.
+
+    beta_init : ndarray
+        Initial coefficients, one row per gene.
+
+    ridge : float
+        Ridge regularization factor, added to the diagonal of :math:`X^t W X`.
+
+    min_mu : float
+        Lower threshold for fitted means.
+
+    beta_tol : float
+        Stopping criterion on the relative change of the coefficients (and of the
+        deviance, checked every 5 iterations).
+
+    max_beta : float
+        Coefficients above this value in absolute value flag divergence.
+
+    maxiter : int
+        Maximum number of IRLS iterations.
+
+    Returns
+    -------
+    beta : ndarray
+        Fitted coefficients, one row per gene.
+
+    mu : ndarray
+        Fitted means. Rows: genes, columns: samples.
+
+    diverged : ndarray
+        Whether IRLS diverged (or hit ``maxiter``) for each gene.
+    """
+    num_genes = counts.shape[0]
+    beta = np.empty_like(beta_init)
+    mu = np.empty_like(counts)
+    diverged = np.zeros(num_genes, dtype=np.bool_)
+
+    # For an intercept plus a single covariate, pass the covariate column to the
+    # unrolled two-coefficient kernels. An empty column selects the generic ones.
+    x_col = np.empty(0)
+    if X.shape[1] == 2 and np.all(X[:, 0] == 1.0):
+        x_col = X[:, 1].copy()
+
+    for g in prange(num_genes):
+        diverged[g] = _irls_loop(
+            counts[g],
+            cs[g],
+            X,
+            x_col,
+            disp[g],
+            beta_init[g],
+            ridge,
+            min_mu,
+            beta_tol,
+            max_beta,
+            maxiter,
+            beta[g],
+            mu[g],
+        )
+
+    return beta, mu, diverged
+
+
+@njit(cache=True, error_model="numpy")
+def _irls_loop(
+    counts: np.ndarray,
+    cs: np.ndarray,
+    X: np.ndarray,
+    x_col: np.ndarray,
+    disp: float,
+    beta_init: np.ndarray,
+    ridge: float,
+    min_mu: float,
+    beta_tol: float,
+    max_beta: float,
+    maxiter: int,
+    beta_out: np.ndarray,
+    mu_out: np.ndarray,
+) -> bool:
+    """Iterate IRLS updates for a single gene until the coefficients stabilize.
+
+    The coefficients and fitted means are written to ``beta_out`` and ``mu_out``.
+    All work buffers are allocated once, before iterating. If ``x_col`` is not
+    empty, ``X`` is an intercept followed by ``x_col`` and the specialized
+    two-coefficient kernels are used.
+
+    Returns whether IRLS diverged, in which case the caller is expected to refit the
+    gene with another optimizer. Genes with non-finite offsets (e.g. a null copy
+    number), dispersion or initial coefficients are reported as diverged without
+    iterating, as are genes whose updated coefficients become non-finite.
+    """
+    num_samples, num_vars = X.shape
+    beta = beta_init.copy()
+    beta_hat = np.empty(num_vars)
+    XtWX = np.empty((num_vars, num_vars))
+    mu = np.empty(num_samples)
+    mu_hat = np.empty(num_samples)
+    # Log offsets of the working responses, constant across iterations
+    log_cs = np.log(cs)
+    two_coefs = x_col.shape[0] > 0
+
+    if not (
+        np.all(np.isfinite(log_cs)) and np.all(np.isfinite(beta)) and np.isfinite(disp)
+    ):
+        beta_out[:] = beta
+        mu_out[:] = np.nan
+        return True
+
+    if two_coefs:
+        _fitted_mu_p2(x_col, beta, cs, min_mu, mu)
+    else:
+        _fitted_mu(X, beta, cs, min_mu, mu)
+
     dev = 1000.0
-    dev_ratio = 1.0
+    diverged = False
 
-    ridge_factor = np.diag(np.repeat(1e-6, num_vars))
-    mu = np.maximum(cnv * size_factors * np.exp(np.clip(X @ beta, -30, 30)), min_mu)
-    
-    converged = True
     i = 0
-    while dev_ratio > beta_tol:
-        W = mu / (1.0 + mu * disp)
-        z = np.log((mu / cnv) / size_factors) + (counts - mu) / mu
-        H = (X.T * W) @ X + ridge_factor
-        beta_hat = solve(H, X.T @ (W * z), assume_a="pos")
+    while True:
+        if two_coefs:
+            _irls_step_p2(counts, log_cs, x_col, mu, disp, ridge, beta_hat)
+        else:
+            _irls_step(counts, log_cs, X, mu, disp, ridge, XtWX, beta_hat)
         i += 1
 
-        if sum(np.abs(beta_hat) > max_beta) > 0 or i >= maxiter:
-            # If IRLS starts diverging, use L-BFGS-B
-            def f(beta: np.ndarray) -> float:
-                # closure to minimize
-                mu_ = np.maximum(cnv * size_factors * np.exp(np.clip(X @ beta, -30, 30)), min_mu)
-                
-                return nb_nll(counts, mu_, disp) + 0.5 * (ridge_factor @ beta**2).sum()
-
-            def df(beta: np.ndarray) -> np.ndarray:
-                mu_ = np.maximum(cnv * size_factors * np.exp(np.clip(X @ beta, -30, 30)), min_mu)
-                return (
-                    -X.T @ counts
-                    + ((1 / disp + counts) * mu_ / (1 / disp + mu_)) @ X
-                    + ridge_factor @ beta
+        if (
+            not np.all(np.isfinite(beta_hat))
+            or np.any(np.abs(beta_hat) > max_beta)
+            or i >= maxiter
+        ):
+            diverged = True
+            break
+
+        # Relative change of the coefficients, much cheaper than the deviance
+        beta_ratio = np.max(np.abs(beta_hat - beta)) / (np.max(np.abs(beta)) + 1e-10)
+
+        if two_coefs:
+            _fitted_mu_p2(x_col, beta_hat, cs, min_mu, mu_hat)
+        else:
+            _fitted_mu(X, beta_hat, cs, min_mu, mu_hat)
+        beta, beta_hat = beta_hat, beta
+        mu, mu_hat = mu_hat, mu
+
+        if beta_ratio < beta_tol:
+            break
+
+        # Deviance check every few iterations, as a safety net
+        if i % 5 == 0:
+            old_dev = dev
+            # Replaced deviation with -2 * nll, as in the R code
+            dev = -2 * _nb_nll(counts, mu, disp)
+            if np.abs(dev - old_dev) / (np.abs(dev) + 0.1) < beta_tol:
+                break
+
+    beta_out[:] = beta
+    mu_out[:] = mu
+    return diverged
+
+
+@njit(cache=True, error_model="numpy")
+def _irls_step(
+    counts: np.ndarray,
+    log_cs: np.ndarray,
+    X: np.ndarray,
+    mu: np.ndarray,
+    disp: float,
+    ridge: float,
+    XtWX: np.ndarray,
+    beta_hat: np.ndarray,
+) -> None:
+    """Perform a single IRLS update of the CN-aware NB GLM coefficients.
+
+    The weights and working responses are computed in a single pass over samples,
+    during which the ``p x p`` normal equations are accumulated. These are then
+    solved in place, in closed form for two-variable designs and with a Cholesky
+    factorization otherwise.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Raw counts for a given gene.
+
+    log_cs : ndarray
+        Logarithms of the products of copy number values and size factors for a
+        given gene.
+
+    X : ndarray
+        Design matrix.
+
+    mu : ndarray
+        Means fitted from the current coefficients.
+
+    disp : float
+        Gene-wise dispersion.
+
+    ridge : float
+        Ridge regularization factor, added to the diagonal of :math:`X^t W X`.
+
+    XtWX : ndarray
+        Work buffer for the ``p x p`` normal equations.
+
+    beta_hat : ndarray
+        Output buffer for the updated coefficients.
+    """
+    num_samples, num_vars = X.shape
+    XtWX[:] = 0.0
+    for j in range(num_vars):
+        XtWX[j, j] = ridge
+    beta_hat[:] = 0.0
+
+    for i in range(num_samples):
+        w = mu[i] / (1.0 + mu[i] * disp)
+        z = np.log(mu[i]) - log_cs[i] + counts[i] / mu[i] - 1.0
+        for j in range(num_vars):
+            xw = X[i, j] * w
+            beta_hat[j] += xw * z
+            for k in range(j + 1):
+                XtWX[j, k] += xw * X[i, k]
+
+    # Only the lower triangle was accumulated
+    for j in range(num_vars):
+        for k in range(j + 1, num_vars):
+            XtWX[j, k] = XtWX[k, j]
+
+    if num_vars == 2:
+        # Closed-form inverse, much cheaper than a factorization for 2 x 2 systems
+        b0, b1 = beta_hat[0], beta_hat[1]
+        det = XtWX[0, 0] * XtWX[1, 1] - XtWX[1, 0] * XtWX[1, 0]
+        beta_hat[0] = (XtWX[1, 1] * b0 - XtWX[1, 0] * b1) / det
+        beta_hat[1] = (XtWX[0, 0] * b1 - XtWX[1, 0] * b0) / det
+        return
+
+    # Solve L L^T beta = X^t W z by forward and backward substitution
+    L = np.linalg.cholesky(XtWX)
+    for j in range(num_vars):
+        for k in range(j):
+            beta_hat[j] -= L[j, k] * beta_hat[k]
+        beta_hat[j] /= L[j, j]
+    for j in range(num_vars - 1, -1, -1):
+        for k in range(j + 1, num_vars):
+            beta_hat[j] -= L[k, j] * beta_hat[k]
+        beta_hat[j] /= L[j, j]
+
+
+@njit(cache=True, error_model="numpy")
+def _fitted_mu(
+    X: np.ndarray,
+    beta: np.ndarray,
+    cs: np.ndarray,
+    min_mu: float,
+    out: np.ndarray,
+) -> None:
+    r"""Write thresholded NB means :math:`\max(c_j e^{x_j^t \beta}, \mu_{min})` to ``out``.
+
+    Fuses the linear predictor, exponential and threshold in a single pass.
+    """
+    num_samples, num_vars = X.shape
+    for i in range(num_samples):
+        eta = 0.0
+        for j in range(num_vars):
+            eta += X[i, j] * beta[j]
+        out[i] = max(cs[i] * np.exp(min(max(eta, -30.0), 30.0)), min_mu)
+
+
+@njit(cache=True, error_model="numpy")
+def _irls_step_p2(
+    counts: np.ndarray,
+    log_cs: np.ndarray,
+    x: np.ndarray,
+    mu: np.ndarray,
+    disp: float,
+    ridge: float,
+    beta_hat: np.ndarray,
+) -> None:
+    """IRLS update for a design made of an intercept and a single covariate ``x``.
+
+    Same update as :func:`_irls_step`, with the ``2 x 2`` normal equations
+    accumulated as scalars and solved in closed form.
+    """
+    a = ridge
+    b = 0.0
+    c = ridge
+    r0 = 0.0
+    r1 = 0.0
+    for i in range(x.shape[0]):
+        w = mu[i] / (1.0 + mu[i] * disp)
+        wz = w * (np.log(mu[i]) - log_cs[i] + counts[i] / mu[i] - 1.0)
+        wx = w * x[i]
+        a += w
+        b += wx
+        c += wx * x[i]
+        r0 += wz
+        r1 += wz * x[i]
+
+    det = a * c - b * b
+    beta_hat[0] = (c * r0 - b * r1) / det
+    beta_hat[1] = (a * r1 - b * r0) / det
+
+
+@njit(cache=True, error_model="numpy")
+def _fitted_mu_p2(
+    x: np.ndarray,
+    beta: np.ndarray,
+    cs: np.ndarray,
+    min_mu: float,
+    out: np.ndarray,
+) -> None:
+    """:func:`_fitted_mu` for a design made of an intercept and a single covariate."""
+    for i in range(x.shape[0]):
+        eta = beta[0] + beta[1] * x[i]
+        out[i] = max(cs[i] * np.exp(min(max(eta, -30.0), 30.0)), min_mu)
+
+
+@njit(cache=True, error_model="numpy", parallel=True)
+def _hat_diagonals(
+    X: np.ndarray,
+    mu: np.ndarray,
+    disp: np.ndarray,
+    ridge: float,
+) -> np.ndarray:
+    r"""Diagonals of the hat matrices :math:`W^{1/2} X (X^t W X)^{-1} X^t W^{1/2}`.
+
+    With :math:`X^t W X = L L^t`, each diagonal entry is
+    :math:`H_{ii} = W_i \Vert L^{-1} x_i \Vert^2`, so only one forward substitution
+    per sample is needed and the ``n x n`` hat matrix is never formed. Two-variable
+    designs use the closed-form ``2 x 2`` inverse instead. Genes are processed in
+    parallel threads.
+
+    Parameters
+    ----------
+    X : ndarray
+        Design matrix.
+
+    mu : ndarray
+        Fitted means. Rows: genes, columns: samples.
+
+    disp : ndarray
+        Gene-wise dispersions.
+
+    ridge : float
+        Ridge regularization factor, added to the diagonal of :math:`X^t W X`.
+
+    Returns
+    -------
+    ndarray
+        Hat diagonals. Rows: genes, columns: samples.
+    """
+    num_genes, num_samples = mu.shape
+    num_vars = X.shape[1]
+    H = np.empty_like(mu)
+
+    for g in prange(num_genes):
+        # Work buffers are private to each thread
+        W = np.empty(num_samples)
+        XtWX = np.zeros((num_vars, num_vars))
+        v = np.empty(num_vars)
+        for j in range(num_vars):
+            XtWX[j, j] = ridge
+        if not (np.all(np.isfinite(mu[g])) and np.isfinite(disp[g])):
+            H[g] = np.nan
+            continue
+        for i in range(num_samples):
+            W[i] = mu[g, i] / (1.0 + mu[g, i] * disp[g])
+            for j in range(num_vars):
+                for k in range(j + 1):
+                    XtWX[j, k] += X[i, j] * W[i] * X[i, k]
+
+        if num_vars == 2:
+            # x^t (X^t W X)^{-1} x in closed form
+            det = XtWX[0, 0] * XtWX[1, 1] - XtWX[1, 0] * XtWX[1, 0]
+            for i in range(num_samples):
+                H[g, i] = (
+                    W[i]
+                    * (
+                        XtWX[1, 1] * X[i, 0] * X[i, 0]
+                        - 2.0 * XtWX[1, 0] * X[i, 0] * X[i, 1]
+                        + XtWX[0, 0] * X[i, 1] * X[i, 1]
+                    )
+                    / det
                 )
+            continue
 
-            res = minimize(
-                f,
-                beta_init,
-                jac=df,
-                method=optimizer,
-                bounds=(
-                    [(min_beta, max_beta)] * num_vars
-                    if optimizer == "L-BFGS-B"
-                    else None
-                ),
-            )
-            
-            beta = res.x
-            mu = np.maximum(cnv * size_factors * np.exp(np.clip(X @ beta, -30, 30)), min_mu)
-            converged = res.success
+        for j in range(num_vars):
+            for k in range(j + 1, num_vars):
+                XtWX[j, k] = XtWX[k, j]
 
-        beta = beta_hat
-        mu = np.maximum(cnv * size_factors * np.exp(np.clip(X @ beta, -30, 30)), min_mu)
-        
-        # Compute deviation
-        old_dev = dev
-        # Replaced deviation with -2 * nll, as in the R code
-        dev = -2 * nb_nll(counts, mu, disp)
-        dev_ratio = np.abs(dev - old_dev) / (np.abs(dev) + 0.1)
-
-    # Compute H diagonal (useful for Cook distance outlier filtering)
-    W = mu / (1.0 + mu * disp)
-    W_sq = np.sqrt(W)
-    XtWX = (X.T * W) @ X + ridge_factor
-    H = W_sq * np.diag(X @ np.linalg.inv(XtWX) @ X.T) * W_sq
-    
-    # Return an UNthresholded mu 
-    # Previous quantities are estimated with a threshold though
-    mu = np.maximum(cnv * size_factors * np.exp(np.clip(X @ beta, -30, 30)), min_mu)
-    
-    return beta, mu, H, converged
+        L = np.linalg.cholesky(XtWX)
+        for i in range(num_samples):
+            sq_norm = 0.0
+            for j in range(num_vars):
+                v[j] = X[i, j]
+                for k in range(j):
+                    v[j] -= L[j, k] * v[k]
+                v[j] /= L[j, j]
+                sq_norm += v[j] * v[j]
+            H[g, i] = W[i] * sq_norm
+
+    return H
+
+
+@njit(cache=True, error_model="numpy")
+def _nb_nll(counts: np.ndarray, mu: np.ndarray, disp: float) -> float:
+    """Negative binomial negative log-likelihood for a scalar dispersion.
+
+    Compiled counterpart of :func:`nb_nll`, used for the IRLS deviance check.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Observations.
+
+    mu : ndarray
+        Mean of the distribution.
+
+    disp : float
+        Dispersion of the distribution.
+
+    Returns
+    -------
+    float
+        Negative log likelihood of the observations.
+    """
+    alpha_neg1 = 1.0 / disp
+    lgamma_alpha_neg1 = lgamma(alpha_neg1)
+    nll = counts.shape[0] * alpha_neg1 * np.log(disp)
+    for i in range(counts.shape[0]):
+        logbinom = (
+            lgamma(counts[i] + alpha_neg1)
+            - lgamma(counts[i] + 1.0)
+            - lgamma_alpha_neg1
+        )
+        nll += (
+            -logbinom
+            + (counts[i] + alpha_neg1) * np.log(alpha_neg1 + mu[i])
+            - counts[i] * np.log(mu[i])
+        )
+    return nll
+
+
+@njit(cache=True, error_model="numpy", parallel=True)
+def _nb_nll_genes(counts: np.ndarray, mu: np.ndarray, disp: np.ndarray) -> np.ndarray:
+    """:func:`_nb_nll` of every gene of a batch, stored with one row per gene."""
+    nll = np.empty(counts.shape[0])
+    for g in prange(counts.shape[0]):
+        nll[g] = _nb_nll(counts[g], mu[g], disp[g])
+    return nll
+
+
+@njit(cache=True, error_model="numpy")
+def _nb_obj_grad(
+    beta: np.ndarray,
+    counts: np.ndarray,
+    cs: np.ndarray,
+    X: np.ndarray,
+    disp: float,
+    min_mu: float,
+    ridge: float,
+) -> Tuple[float, np.ndarray]:
+    """Ridge-penalized NB negative log-likelihood of a GLM, and its gradient.
+
+    Objective of the L-BFGS-B fallback of :func:`irls_glm_batch`, returning both
+    values from a single pass so it can be used with ``jac=True``.
+
+    Parameters
+    ----------
+    beta : ndarray
+        GLM coefficients.
+
+    counts : ndarray
+        Raw counts for a given gene.
+
+    cs : ndarray
+        Products of copy number values and size factors for a given gene.
+
+    X : ndarray
+        Design matrix.
+
+    disp : float
+        Gene-wise dispersion.
+
+    min_mu : float
+        Lower threshold for fitted means.
+
+    ridge : float
+        Ridge regularization factor.
+
+    Returns
+    -------
+    float
+        Penalized negative log-likelihood.
+
+    ndarray
+        Gradient with respect to ``beta``.
+    """
+    num_samples, num_vars = X.shape
+    mu = np.empty(num_samples)
+    _fitted_mu(X, beta, cs, min_mu, mu)
+
+    alpha_neg1 = 1.0 / disp
+    grad = ridge * beta
+    for i in range(num_samples):
+        r = (alpha_neg1 + counts[i]) * mu[i] / (alpha_neg1 + mu[i]) - counts[i]
+        for j in range(num_vars):
+            grad[j] += r * X[i, j]
+
+    return _nb_nll(counts, mu, disp) + 0.5 * ridge * (beta**2).sum(), grad
+
+
+def alpha_mle_batch(
+    counts: np.ndarray,
+    design_matrix: np.ndarray,
+    mu: np.ndarray,
+    alpha_hat: np.ndarray,
+    min_disp: float,
+    max_disp: float,
+    prior_disp_var: Optional[float] = None,
+    cr_reg: bool = True,
+    prior_reg: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Estimate the dispersion parameters of NB GLMs for a batch of genes.
+
+    Compiled counterpart of :func:`pydeseq2.utils.fit_alpha_mle`. For each gene, the
+    (Cox-Reid and prior regularized) negative log-likelihood is minimized over
+    :math:`\\log \\alpha` within ``[log(min_disp), log(max_disp)]``, by bracketing a
+    sign change of its derivative from the initial estimate and refining it with
+    regula falsi. Genes run in parallel threads. Genes for which the search fails
+    are fitted by grid search.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Raw counts. Rows: samples, columns: genes.
+
+    design_matrix : ndarray
+        Design matrix.
+
+    mu : ndarray
+        Mean estimations for the NB model. Rows: samples, columns: genes.
+
+    alpha_hat : ndarray
+        Initial dispersion estimates, also used as the prior means when
+        ``prior_reg`` is ``True``.
+
+    min_disp : float
+        Lower threshold for dispersion parameters.
+
+    max_disp : float
+        Upper threshold for dispersion parameters.
+
+    prior_disp_var : float
+        Prior dispersion variance.
+
+    cr_reg : bool
+        Whether to use Cox-Reid regularization. (default: ``True``).
+
+    prior_reg : bool
+        Whether to use prior log-residual regularization. (default: ``False``).
+
+    Returns
+    -------
+    ndarray
+        Dispersion estimates.
+
+    ndarray
+        Whether the optimization converged for each gene. If not, the dispersion
+        was estimated using grid search.
+    """
+    if prior_reg and prior_disp_var is None:
+        raise ValueError("Sigma_prior is required for prior regularization")
+
+    X = np.ascontiguousarray(design_matrix, dtype=float)
+    counts_g = np.ascontiguousarray(counts.T, dtype=float)
+    mu_g = np.ascontiguousarray(mu.T, dtype=float)
+    log_alpha_hat = np.log(np.asarray(alpha_hat, dtype=float))
+
+    log_alpha, converged = _alpha_mle_genes(
+        counts_g,
+        mu_g,
+        X,
+        log_alpha_hat,
+        np.log(min_disp),
+        np.log(max_disp),
+        prior_disp_var if prior_reg else 1.0,
+        cr_reg,
+        prior_reg,
+    )
+
+    # Same fallback as pydeseq2's fit_alpha_mle
+    for g in np.flatnonzero(~converged):
+        log_alpha[g] = grid_fit_alpha(
+            counts_g[g], X, mu_g[g], np.exp(log_alpha_hat[g]), min_disp, max_disp
+        )
+
+    return np.exp(log_alpha), converged
+
+
+@njit(cache=True, parallel=True)
+def _alpha_mle_genes(
+    counts: np.ndarray,
+    mu: np.ndarray,
+    X: np.ndarray,
+    log_alpha_hat: np.ndarray,
+    min_log_alpha: float,
+    max_log_alpha: float,
+    prior_disp_var: float,
+    cr_reg: bool,
+    prior_reg: bool,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Fit log-dispersions for every gene of a batch, in parallel threads.
+
+    Counts and means are stored with one row per gene. See :func:`alpha_mle_batch`.
+    """
+    num_genes = counts.shape[0]
+    log_alpha = np.empty(num_genes)
+    converged = np.zeros(num_genes, dtype=np.bool_)
+
+    for g in prange(num_genes):
+        log_alpha[g], converged[g] = _alpha_mle_gene(
+            counts[g],
+            mu[g],
+            X,
+            log_alpha_hat[g],
+            min_log_alpha,
+            max_log_alpha,
+            prior_disp_var,
+            cr_reg,
+            prior_reg,
+        )
+
+    return log_alpha, converged
+
+
+@njit(cache=True, error_model="numpy")
+def _alpha_mle_gene(
+    counts: np.ndarray,
+    mu: np.ndarray,
+    X: np.ndarray,
+    log_alpha_hat: float,
+    min_log_alpha: float,
+    max_log_alpha: float,
+    prior_disp_var: float,
+    cr_reg: bool,
+    prior_reg: bool,
+    xtol: float = 1e-10,
+    maxiter: int = 200,
+) -> Tuple[float, bool]:
+    """Minimize the dispersion loss of a single gene over its log-dispersion.
+
+    Starting from ``log_alpha_hat``, steps of doubling length are taken downhill
+    until the derivative changes sign (or a bound is reached), and the resulting
+    bracket is then refined with the Illinois variant of regula falsi.
+    """
+    a = min(max(log_alpha_hat, min_log_alpha), max_log_alpha)
+    ga = _dloss_log_alpha(
+        a, counts, mu, X, log_alpha_hat, prior_disp_var, cr_reg, prior_reg
+    )
+    if ga == 0.0:
+        return a, True
+    if not np.isfinite(ga):
+        return a, False
+
+    # Bracket a sign change of the derivative, downhill from the initial estimate
+    direction = -1.0 if ga > 0.0 else 1.0
+    bound = min_log_alpha if ga > 0.0 else max_log_alpha
+    step = 1.0
+    for _ in range(maxiter):
+        b = a + direction * step
+        if direction * (b - bound) >= 0.0:
+            b = bound
+        gb = _dloss_log_alpha(
+            b, counts, mu, X, log_alpha_hat, prior_disp_var, cr_reg, prior_reg
+        )
+        if not np.isfinite(gb):
+            return b, False
+        if gb * ga <= 0.0:
+            break
+        if b == bound:
+            # Still decreasing at the bound
+            return b, True
+        a, ga = b, gb
+        step *= 2.0
+    else:
+        return a, False
+
+    # Illinois method on the bracket [a, b]
+    for _ in range(maxiter):
+        if gb == 0.0 or abs(b - a) < xtol:
+            return b, True
+        c = b - gb * (b - a) / (gb - ga)
+        gc = _dloss_log_alpha(
+            c, counts, mu, X, log_alpha_hat, prior_disp_var, cr_reg, prior_reg
+        )
+        if not np.isfinite(gc):
+            return c, False
+        if gc * gb < 0.0:
+            a, ga = b, gb
+        else:
+            ga *= 0.5
+        b, gb = c, gc
+
+    return b, False
+
+
+@njit(cache=True, error_model="numpy")
+def _dloss_log_alpha(
+    log_alpha: float,
+    counts: np.ndarray,
+    mu: np.ndarray,
+    X: np.ndarray,
+    log_alpha_hat: float,
+    prior_disp_var: float,
+    cr_reg: bool,
+    prior_reg: bool,
+) -> float:
+    """Derivative of the dispersion loss of :func:`alpha_mle_batch` wrt log-alpha."""
+    num_samples, num_vars = X.shape
+    alpha = np.exp(log_alpha)
+    alpha_neg1 = 1.0 / alpha
+
+    # NB negative log-likelihood, as in pydeseq2's dnb_nll (times alpha)
+    digamma_alpha_neg1 = _digamma(alpha_neg1)
+    ll_part = 0.0
+    for i in range(num_samples):
+        ll_part += (
+            digamma_alpha_neg1
+            - _digamma(counts[i] + alpha_neg1)
+            + np.log(1.0 + mu[i] * alpha)
+            + (counts[i] - mu[i]) / (mu[i] + alpha_neg1)
+        )
+    grad = -alpha_neg1 * ll_part
+
+    if cr_reg:
+        # 0.5 * d/dlog(alpha) log det(X^t W X), with dW/dalpha = -W^2
+        XtWX = np.zeros((num_vars, num_vars))
+        W = np.empty(num_samples)
+        for i in range(num_samples):
+            W[i] = mu[i] / (1.0 + mu[i] * alpha)
+            for j in range(num_vars):
+                for k in range(j + 1):
+                    XtWX[j, k] += X[i, j] * W[i] * X[i, k]
+        for j in range(num_vars):
+            for k in range(j + 1, num_vars):
+                XtWX[j, k] = XtWX[k, j]
+
+        # tr((X^t W X)^{-1} X^t dW X) = sum_i dW_i ||L^{-1} x_i||^2
+        L = np.linalg.cholesky(XtWX)
+        v = np.empty(num_vars)
+        trace = 0.0
+        for i in range(num_samples):
+            sq_norm = 0.0
+            for j in range(num_vars):
+                v[j] = X[i, j]
+                for k in range(j):
+                    v[j] -= L[j, k] * v[k]
+                v[j] /= L[j, j]
+                sq_norm += v[j] * v[j]
+            trace -= W[i] * W[i] * sq_norm
+        grad += 0.5 * trace * alpha
+
+    if prior_reg:
+        grad += (log_alpha - log_alpha_hat) / prior_disp_var
+
+    return grad
+
+
+@njit(cache=True)
+def _digamma(x: float) -> float:
+    """Digamma function for positive arguments.
+
+    Uses the recurrence :math:`\\psi(x) = \\psi(x + 1) - 1 / x` to reach ``x >= 10``,
+    then the asymptotic expansion.
+    """
+    result = 0.0
+    while x < 10.0:
+        result -= 1.0 / x
+        x += 1.0
+    f = 1.0 / (x * x)
+    return (
+        result
+        + np.log(x)
+        - 0.5 / x
+        - f
+        * (
+            1.0 / 12
+            - f * (1.0 / 120 - f * (1.0 / 252 - f * (1.0 / 240 - f * (1.0 / 132))))
+        )
+    )
 
 
 def fit_lin_mu(
@@ -231,15 +1251,268 @@ def fit_moments_dispersions2(
     ndarray
         Estimated dispersion parameter for each gene.
     """
-    # Exclude genes with all zeroes
-    #normed_counts = normed_counts[:, ~(normed_counts == 0).all(axis=0)]
     # mean inverse size factor
-    s_mean_inv = (1 /size_factors).mean()
-    mu = normed_counts.mean(0)
-    sigma = normed_counts.var(0, ddof=1)
-    # ddof=1 is to use an unbiased estimator, as in R
-    # NaN (variance = 0) are replaced with 0s
-    return np.nan_to_num((sigma - s_mean_inv * mu) / mu**2)
+    s_mean_inv = (1 / size_factors).mean()
+    # Genes with all zeroes are skipped and get a 0 estimate
+    return _moments_dispersions(np.ascontiguousarray(normed_counts), s_mean_inv)
+
+
+@njit(cache=True, error_model="numpy", parallel=True)
+def _moments_dispersions(normed_counts: np.ndarray, s_mean_inv: float) -> np.ndarray:
+    r"""Method of moments dispersions :math:`(\sigma^2 - \bar{s^{-1}} \mu) / \mu^2`.
+
+    Means and unbiased variances (``ddof=1``, as in R) are computed gene by gene
+    without forming intermediate ``n_samples x n_genes`` arrays.
+    """
+    num_samples, num_genes = normed_counts.shape
+    alpha = np.zeros(num_genes)
+
+    for g in prange(num_genes):
+        mu = 0.0
+        for i in range(num_samples):
+            mu += normed_counts[i, g]
+        if mu == 0.0:
+            continue
+        mu /= num_samples
+
+        sigma = 0.0
+        for i in range(num_samples):
+            d = normed_counts[i, g] - mu
+            sigma += d * d
+        sigma /= num_samples - 1
+
+        alpha[g] = (sigma - s_mean_inv * mu) / (mu * mu)
+
+    return alpha
+
+
+def normed_means(counts: np.ndarray, size_factors: np.ndarray) -> np.ndarray:
+    """Gene-wise means of the normalized counts.
+
+    Equivalent to ``(counts / size_factors[:, None]).mean(0)``, without forming the
+    normalized count matrix.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Raw counts.
+
+    size_factors : ndarray
+        Sample-wise size factors.
+
+    Returns
+    -------
+    ndarray
+        Mean normalized count of each gene.
+    """
+    inv_sf = 1 / np.asarray(size_factors, dtype=float)
+    return _normed_means(np.ascontiguousarray(counts), inv_sf)
+
+
+@njit(cache=True)
+def _normed_means(counts: np.ndarray, inv_sf: np.ndarray) -> np.ndarray:
+    num_samples, num_genes = counts.shape
+    means = np.zeros(num_genes)
+    # Row by row, so that the counts are read contiguously
+    for i in range(num_samples):
+        for g in range(num_genes):
+            means[g] += counts[i, g] * inv_sf[i]
+    means /= num_samples
+    return means
+
+
+def vst_parametric(normed_counts: np.ndarray, a0: float, a1: float) -> np.ndarray:
+    r"""Variance stabilizing transformation for a parametric dispersion trend.
+
+    Computes :math:`\log_2\left((1 + a_1 + 2 a_0 x + 2 \sqrt{a_0 x (1 + a_1 + a_0 x)})
+    / (4 a_0)\right)` elementwise, in a single compiled pass.
+
+    Parameters
+    ----------
+    normed_counts : ndarray
+        Normalized counts.
+
+    a0 : float
+        Asymptotic dispersion coefficient of the trend.
+
+    a1 : float
+        Extra-Poisson dispersion coefficient of the trend.
+
+    Returns
+    -------
+    ndarray
+        Variance stabilized counts.
+    """
+    x = np.ascontiguousarray(normed_counts)
+    vst_counts = np.empty(x.shape)
+    _vst_parametric(x.ravel(), a0, a1, vst_counts.ravel())
+    return vst_counts
+
+
+def vst_mean(normed_counts: np.ndarray, mean_disp: float) -> np.ndarray:
+    r"""Variance stabilizing transformation for a constant (mean) dispersion.
+
+    Computes :math:`(2 \operatorname{arcsinh}(\sqrt{\alpha x}) - \log(4 \alpha))
+    / \log 2` elementwise, in a single compiled pass.
+
+    Parameters
+    ----------
+    normed_counts : ndarray
+        Normalized counts.
+
+    mean_disp : float
+        Trimmed mean of the gene-wise dispersions.
+
+    Returns
+    -------
+    ndarray
+        Variance stabilized counts.
+    """
+    x = np.ascontiguousarray(normed_counts)
+    vst_counts = np.empty(x.shape)
+    _vst_mean(x.ravel(), mean_disp, vst_counts.ravel())
+    return vst_counts
+
+
+@njit(cache=True, parallel=True)
+def _vst_parametric(x: np.ndarray, a0: float, a1: float, out: np.ndarray) -> None:
+    for i in prange(x.shape[0]):
+        t = a0 * x[i]
+        out[i] = np.log2((1.0 + a1 + 2.0 * t + 2.0 * np.sqrt(t * (1.0 + a1 + t))) / (4.0 * a0))
+
+
+@njit(cache=True, parallel=True)
+def _vst_mean(x: np.ndarray, mean_disp: float, out: np.ndarray) -> None:
+    offset = np.log(mean_disp) + np.log(4.0)
+    for i in prange(x.shape[0]):
+        out[i] = (2.0 * np.arcsinh(np.sqrt(mean_disp * x[i])) - offset) / np.log(2.0)
+
+
+def cooks_distances(
+    counts: np.ndarray,
+    mu: np.ndarray,
+    disp: np.ndarray,
+    hat_diagonals: np.ndarray,
+    num_vars: int,
+) -> np.ndarray:
+    r"""Cook's distances of the NB GLM fits.
+
+    Computes :math:`\frac{(y - \mu)^2}{p (\mu + \alpha \mu^2)}
+    \frac{H}{(1 - H)^2}` elementwise, in a single compiled pass.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Raw counts. Rows: samples, columns: genes.
+
+    mu : ndarray
+        Fitted means, of the same shape as ``counts``.
+
+    disp : ndarray
+        Gene-wise dispersions used for the variance.
+
+    hat_diagonals : ndarray
+        Diagonals of the hat matrices, of the same shape as ``counts``.
+
+    num_vars : int
+        Number of coefficients of the design.
+
+    Returns
+    -------
+    ndarray
+        Cook's distances, of the same shape as ``counts``. Entries with a hat
+        diagonal of 1 are infinite (or NaN if their residual is null).
+    """
+    return _cooks_distances(
+        np.ascontiguousarray(counts),
+        np.ascontiguousarray(mu, dtype=float),
+        np.asarray(disp, dtype=float),
+        np.ascontiguousarray(hat_diagonals, dtype=float),
+        num_vars,
+    )
+
+
+@njit(cache=True, error_model="numpy", parallel=True)
+def _cooks_distances(
+    counts: np.ndarray,
+    mu: np.ndarray,
+    disp: np.ndarray,
+    hat: np.ndarray,
+    num_vars: int,
+) -> np.ndarray:
+    num_samples, num_genes = counts.shape
+    cooks = np.empty((num_samples, num_genes))
+    for i in prange(num_samples):
+        for g in range(num_genes):
+            h = hat[i, g]
+            m = mu[i, g]
+            r = counts[i, g] - m
+            cooks[i, g] = r * r * h / ((m + disp[g] * m * m) * num_vars * (1.0 - h) ** 2)
+    return cooks
+
+
+@lru_cache(maxsize=32)
+def cooks_cutoff(num_vars: int, num_samples: int) -> float:
+    """Threshold above which Cook's distances flag outliers.
+
+    The 0.99 quantile of the F distribution with ``num_vars`` and
+    ``num_samples - num_vars`` degrees of freedom. Memoized, as it only depends on
+    the design dimensions.
+
+    Parameters
+    ----------
+    num_vars : int
+        Number of coefficients of the design.
+
+    num_samples : int
+        Number of samples.
+
+    Returns
+    -------
+    float
+        Cook's distance cutoff.
+    """
+    return float(f.ppf(0.99, num_vars, num_samples - num_vars))
+
+
+def trimmed_mean_cols(x: np.ndarray, trim: float = 0.1) -> np.ndarray:
+    """Column-wise trimmed means.
+
+    Same as ``pydeseq2.utils.trimmed_mean(x, trim, axis=0)``, with each column's
+    trimmed values selected by partial partitioning rather than a full sort, and
+    columns processed in parallel.
+
+    Parameters
+    ----------
+    x : ndarray
+        Data whose column means to compute.
+
+    trim : float
+        Fraction of data to trim at each end. (default: ``0.1``).
+
+    Returns
+    -------
+    ndarray
+        Trimmed mean of each column.
+    """
+    assert trim <= 0.5
+    num_rows = x.shape[0]
+    return _trimmed_mean_cols(np.asarray(x, dtype=float), floor(num_rows * trim))
+
+
+@njit(cache=True, parallel=True)
+def _trimmed_mean_cols(x: np.ndarray, ntrim: int) -> np.ndarray:
+    num_rows, num_cols = x.shape
+    num_kept = num_rows - 2 * ntrim
+    means = np.empty(num_cols)
+    for j in prange(num_cols):
+        col = x[:, j].copy()
+        if ntrim > 0:
+            # Move the ntrim smallest values first, then the ntrim largest last
+            col = np.partition(col, ntrim)
+            col = np.partition(col[ntrim:], num_kept)
+        means[j] = col[:num_kept].mean()
+    return means
 
 
 def nb_nll(
@@ -316,6 +1589,57 @@ def nb_nll(
         )
 
 
+def trimmed_sf_nll(
+    log_sf: np.ndarray,
+    counts: np.ndarray,
+    base_mu: np.ndarray,
+    alpha: np.ndarray,
+    quant: float = 0.95,
+) -> Tuple[float, np.ndarray]:
+    """Trimmed NB negative log-likelihood of size factors, and its gradient.
+
+    Objective of the ``iterative`` size factor fit. The size factors are
+    ``exp(log_sf - mean(log_sf))``, and each gene's mean is ``base_mu`` scaled by
+    them. The genes whose negative log-likelihood is above its ``quant`` quantile
+    are left out of the sum.
+
+    Parameters
+    ----------
+    log_sf : ndarray
+        Log size factors, up to a constant.
+
+    counts : ndarray
+        Raw counts. Rows: samples, columns: genes.
+
+    base_mu : ndarray
+        Fitted means for unit size factors. Rows: samples, columns: genes.
+
+    alpha : ndarray
+        Gene-wise dispersions.
+
+    quant : float
+        Quantile value at which negative likelihood is cut. (default: ``0.95``).
+
+    Returns
+    -------
+    float
+        Trimmed negative log-likelihood.
+
+    ndarray
+        Gradient with respect to ``log_sf``, for the current set of kept genes.
+    """
+    sf = np.exp(log_sf - np.mean(log_sf))
+    mu = base_mu * sf[:, None]
+    nll = nb_nll(counts=counts, mu=mu, alpha=alpha)
+    # Take out the lowest likelihoods (highest neg) from the sum
+    kept = nll < np.quantile(nll, quant)
+    # d nll / d log(mu) = (mu - y) / (1 + alpha * mu), projected on the centering of
+    # the log size factors
+    mu_kept = mu[:, kept]
+    grad = ((mu_kept - counts[:, kept]) / (1 + alpha[kept] * mu_kept)).sum(1)
+    return np.sum(nll[kept]), grad - grad.mean()
+
+
 def nbinomGLM(
     design_matrix: np.ndarray,
     counts: np.ndarray,
@@ -437,7 +1761,11 @@ def nbinomGLM(
 
         h = np.diag(no_shrink_mask * h11 + shrink_mask * h22)
 
-        return 1 / cnst * ((design_matrix.T * frac) @ design_matrix + np.diag(h))
+        # Symmetric rank-k update, only the lower triangle is computed
+        XtWX = dsyrk(1.0, np.sqrt(frac)[:, None] * design_matrix, trans=1, lower=1)
+        XtWX += np.tril(XtWX, -1).T
+
+        return 1 / cnst * (XtWX + np.diag(h))
 
     res = minimize(
         f,
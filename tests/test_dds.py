@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pydeseq2.utils import n_or_more_replicates
+from pydeseq2.utils import trimmed_mean
+from scipy.stats import f  # type: ignore
+
+from deconveil import deconveil_fit
+
+DATASETS = Path(__file__).resolve().parents[1] / "datasets"
+
+
+def load_fixture(num_genes=200):
+    counts = pd.read_csv(DATASETS / "rna_counts.csv", index_col=0).T
+    metadata = pd.read_csv(DATASETS / "metadata.csv", index_col=0)
+    cnv = (pd.read_csv(DATASETS / "cnv.csv", index_col=0).T * 2).astype(int)
+    return counts.iloc[:, :num_genes].copy(), metadata, cnv.iloc[:, :num_genes]
+
+
+def test_replace_outliers_matches_pydeseq2():
+    counts, metadata, cnv = load_fixture()
+    # Seed a few outlier counts
+    rng = np.random.default_rng(0)
+    for j in rng.choice(counts.shape[1], 20, replace=False):
+        i = rng.integers(counts.shape[0])
+        counts.iloc[i, j] = counts.iloc[i, j] * 60 + 500
+
+    dds = deconveil_fit(
+        counts=counts,
+        cnv=cnv,
+        metadata=metadata,
+        design_factors="condition",
+        min_replicates=7,
+        quiet=True,
+    )
+    dds.fit_size_factors()
+    dds.fit_genewise_dispersions()
+    dds.fit_dispersion_trend()
+    dds.fit_dispersion_prior()
+    dds.fit_MAP_dispersions()
+    dds.fit_LFC()
+    dds.calculate_cooks()
+    dds._replace_outliers()
+
+    # Replacement rule of pydeseq2's DeseqDataSet._replace_outliers
+    num_samples, num_vars = dds.obsm["design_matrix"].shape
+    cooks_cutoff = f.ppf(0.99, num_vars, num_samples - num_vars)
+    with np.errstate(invalid="ignore"):
+        idx = dds.layers["cooks"] > cooks_cutoff
+    replaced = idx.any(axis=0)
+    replaceable = n_or_more_replicates(dds.obsm["design_matrix"], 7).values
+    size_factors = dds.obsm["size_factors"]
+
+    expected = counts.to_numpy()[:, replaced]
+    trim_base_mean = trimmed_mean(expected / size_factors[:, None], trim=0.2, axis=0)
+    replacement_counts = (trim_base_mean[None, :] * size_factors[:, None]).astype(int)
+    mask = replaceable[:, None] & idx[:, replaced]
+    expected[mask] = replacement_counts[mask]
+
+    assert replaced.any() and mask.any()
+    np.testing.assert_array_equal(dds.varm["replaced"], replaced)
+    np.testing.assert_array_equal(dds.counts_to_refit.to_numpy(), expected)
+    np.testing.assert_array_equal(
+        dds.counts_to_refit.columns, counts.columns[replaced]
+    )
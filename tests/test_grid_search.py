@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from scipy.special import gammaln  # type: ignore
+
+from deconveil.grid_search import grid_fit_beta
+
+
+def nb_nll(counts, mu, alpha):
+    """Exact NB negative log-likelihood, in double precision."""
+    alpha_neg1 = 1 / alpha
+    return -(
+        gammaln(counts + alpha_neg1)
+        - gammaln(counts + 1)
+        - gammaln(alpha_neg1)
+        + alpha_neg1 * np.log(alpha_neg1 / (alpha_neg1 + mu))
+        + counts * np.log(mu / (alpha_neg1 + mu))
+    ).sum()
+
+
+def reference_grid_fit_beta(counts, size_factors, design_matrix, disp, cnv):
+    """Same two-stage grid search as ``grid_fit_beta``, on the exact NLL."""
+    grid_length, min_mu = 60, 0.5
+    cs = cnv * size_factors
+
+    def loss(beta):
+        mu = np.maximum(cs * np.exp(design_matrix @ beta), min_mu)
+        return nb_nll(counts, mu, disp) + 0.5 * 1e-6 * (beta**2).sum()
+
+    def search(x_grid, y_grid):
+        ll = np.array([[loss(np.array([x, y])) for y in y_grid] for x in x_grid])
+        i, j = np.unravel_index(np.argmin(ll), ll.shape)
+        return x_grid[i], y_grid[j]
+
+    grid = np.linspace(-30, 30, grid_length)
+    delta = grid[1] - grid[0]
+    x, y = search(grid, grid)
+    x, y = search(
+        np.linspace(x - delta, x + delta, grid_length),
+        np.linspace(y - delta, y + delta, grid_length),
+    )
+    return np.array([x, y]), loss
+
+
+@pytest.mark.parametrize("disp", [1e-8, 1e-6, 0.1])
+def test_grid_fit_beta_matches_exact_nll(disp):
+    rng = np.random.default_rng(0)
+    n = 10
+    design_matrix = np.column_stack([np.ones(n), np.repeat([0.0, 1.0], n // 2)])
+    size_factors = rng.uniform(0.5, 2.0, n)
+    cnv = rng.choice([0.5, 1.0, 1.5, 2.0], n)
+
+    for _ in range(5):
+        mu = cnv * size_factors * np.exp(design_matrix @ rng.normal([5.0, 0.0], 2.0))
+        counts = rng.poisson(mu).astype(float)
+
+        beta = grid_fit_beta(counts, size_factors, design_matrix, disp, cnv)
+        beta_ref, loss = reference_grid_fit_beta(
+            counts, size_factors, design_matrix, disp, cnv
+        )
+        # Distinct cells may tie in flat regions, so compare the attained losses
+        assert loss(beta) == pytest.approx(loss(beta_ref), rel=1e-9, abs=1e-6)
@@ -0,0 +1,342 @@
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from pydeseq2.dds import DeseqDataSet
+from pydeseq2.utils import fit_alpha_mle
+from pydeseq2.utils import irls_solver
+from pydeseq2.utils import robust_method_of_moments_disp
+from pydeseq2.utils import trimmed_mean
+from scipy.optimize import check_grad  # type: ignore
+from scipy.optimize import minimize  # type: ignore
+from scipy.stats import f  # type: ignore
+
+from deconveil import utils_CNaware
+
+
+@pytest.mark.parametrize("cr_reg", [True, False])
+def test_alpha_mle_batch_degenerate_genes_fall_back(cr_reg):
+    rng = np.random.default_rng(0)
+    num_samples, num_genes = 8, 4
+    design_matrix = np.column_stack(
+        [np.ones(num_samples), np.repeat([0.0, 1.0], num_samples // 2)]
+    )
+    mu = rng.uniform(5.0, 50.0, (num_samples, num_genes))
+    counts = rng.poisson(mu).astype(float)
+    # Gene 1 has NaN means and gene 2 an infinite one: their losses are not finite
+    mu[:, 1] = np.nan
+    mu[2, 2] = np.inf
+
+    with np.errstate(all="ignore"):
+        dispersions, converged = utils_CNaware.alpha_mle_batch(
+            counts,
+            design_matrix,
+            mu,
+            np.full(num_genes, 0.1),
+            1e-8,
+            10.0,
+            cr_reg=cr_reg,
+        )
+
+    np.testing.assert_array_equal(converged, [True, False, False, True])
+    assert np.isfinite(dispersions).all()
+
+
+@pytest.mark.parametrize(
+    "cr_reg, prior_reg", [(True, False), (False, False), (True, True)]
+)
+def test_alpha_mle_batch_matches_pydeseq2(cr_reg, prior_reg):
+    rng = np.random.default_rng(6)
+    num_samples, num_genes = 10, 6
+    design_matrix = np.column_stack(
+        [np.ones(num_samples), np.repeat([0.0, 1.0], num_samples // 2)]
+    )
+    mu = rng.uniform(5.0, 300.0, (num_samples, num_genes))
+    alpha = rng.uniform(0.02, 0.5, num_genes)
+    counts = rng.negative_binomial(1 / alpha, 1 / (1 + alpha * mu)).astype(float)
+    # Poisson counts: without a prior, the dispersion reaches its lower bound
+    counts[:, 3] = rng.poisson(mu[:, 3])
+    # A non-finite loss: both solvers fall back to the same grid search
+    mu[:, 4] = np.nan
+    min_disp, max_disp = 1e-8, 10.0
+    prior_disp_var = 0.5 if prior_reg else None
+
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        dispersions, converged = utils_CNaware.alpha_mle_batch(
+            counts,
+            design_matrix,
+            mu,
+            np.full(num_genes, 0.1),
+            min_disp,
+            max_disp,
+            prior_disp_var=prior_disp_var,
+            cr_reg=cr_reg,
+            prior_reg=prior_reg,
+        )
+        ref = [
+            fit_alpha_mle(
+                counts[:, g],
+                design_matrix,
+                mu[:, g],
+                0.1,
+                min_disp,
+                max_disp,
+                prior_disp_var=prior_disp_var,
+                cr_reg=cr_reg,
+                prior_reg=prior_reg,
+            )
+            for g in range(num_genes)
+        ]
+    ref_dispersions = np.array([r[0] for r in ref])
+    ref_converged = np.array([r[1] for r in ref])
+
+    np.testing.assert_array_equal(converged, ref_converged)
+    assert not converged[4]
+    assert dispersions[4] == ref_dispersions[4]
+    bracketed = np.ones(num_genes, dtype=bool)
+    bracketed[4] = False
+    if not prior_reg:
+        # pydeseq2's L-BFGS-B stops just inside the bound
+        assert dispersions[3] == pytest.approx(min_disp)
+        assert ref_dispersions[3] < 1e-7
+        bracketed[3] = False
+    np.testing.assert_allclose(
+        dispersions[bracketed], ref_dispersions[bracketed], rtol=1e-5
+    )
+
+
+@pytest.mark.parametrize("num_vars", [2, 3])
+def test_irls_glm_batch_null_copy_numbers(num_vars):
+    rng = np.random.default_rng(0)
+    num_samples, num_genes = 10, 4
+    design_matrix = np.column_stack(
+        [np.ones(num_samples), np.repeat([0.0, 1.0], num_samples // 2)]
+    )
+    if num_vars == 3:
+        design_matrix = np.column_stack([design_matrix, rng.normal(size=num_samples)])
+    size_factors = rng.uniform(0.5, 2.0, num_samples)
+    cnv = rng.choice([1.0, 2.0, 3.0], (num_samples, num_genes))
+    counts = rng.poisson(50 * cnv * size_factors[:, None]).astype(float)
+    # Gene 1 has a single null copy number, gene 2 only null ones: their log offsets
+    # are not finite, so IRLS cannot run and the optimizer fallback is used
+    cnv[3, 1] = 0.0
+    cnv[:, 2] = 0.0
+
+    with np.errstate(all="ignore"):
+        beta, mu, H, converged = utils_CNaware.irls_glm_batch(
+            counts, cnv, size_factors, design_matrix, np.full(num_genes, 0.05)
+        )
+
+    assert np.isfinite(beta).all()
+    assert np.isfinite(mu).all()
+    assert np.isfinite(H).all()
+    assert converged[[0, 3]].all()
+    assert not converged[2]
+
+
+@pytest.mark.parametrize("num_vars", [2, 3])
+def test_irls_glm_batch_matches_scalar_solver(num_vars):
+    rng = np.random.default_rng(1)
+    num_samples, num_genes = 12, 4
+    design_matrix = np.column_stack(
+        [np.ones(num_samples), np.repeat([0.0, 1.0], num_samples // 2)]
+    )
+    if num_vars == 3:
+        design_matrix = np.column_stack([design_matrix, rng.normal(size=num_samples)])
+    size_factors = rng.uniform(0.5, 2.0, num_samples)
+    cnv = rng.choice([1.0, 2.0, 3.0], (num_samples, num_genes))
+    cs = cnv * size_factors[:, None]
+    counts = rng.negative_binomial(5, 5 / (5 + 30 * cs)).astype(float)
+    # The intercept of gene 3 exceeds max_beta, so IRLS diverges and the gene is
+    # refitted by the bounded optimizer
+    counts[:, 3] = rng.poisson(1e6, num_samples)
+    disp = np.full(num_genes, 0.2)
+    max_beta = 10.0
+
+    beta, mu, H, converged = utils_CNaware.irls_glm_batch(
+        counts, cnv, size_factors, design_matrix, disp, max_beta=max_beta
+    )
+
+    assert converged.all()
+    assert beta[3, 0] == max_beta
+    for g in range(num_genes):
+        # Copy numbers enter the model as offsets, like size factors
+        ref_beta, ref_mu, ref_H, ref_converged = irls_solver(
+            counts[:, g], cs[:, g], design_matrix, disp[g], max_beta=max_beta
+        )
+        assert ref_converged
+        # pydeseq2 stops on the relative change of the deviance, which only pins
+        # the coefficients down to ~sqrt(beta_tol)
+        np.testing.assert_allclose(beta[g], ref_beta, atol=1e-4)
+        # pydeseq2 returns unthresholded means
+        np.testing.assert_allclose(mu[:, g], np.maximum(ref_mu, 0.5), rtol=1e-4)
+        np.testing.assert_allclose(H[:, g], ref_H, atol=1e-5)
+
+
+def test_irls_glm_batch_non_finite_fit_not_converged():
+    rng = np.random.default_rng(1)
+    num_samples = 10
+    design_matrix = np.column_stack(
+        [np.ones(num_samples), np.repeat([0.0, 1.0], num_samples // 2)]
+    )
+    size_factors = rng.uniform(0.5, 2.0, num_samples)
+    counts = rng.poisson(30, (num_samples, 2)).astype(float)
+    counts[2, 1] = np.nan
+
+    with np.errstate(all="ignore"):
+        _, _, _, converged = utils_CNaware.irls_glm_batch(
+            counts,
+            np.ones((num_samples, 2)),
+            size_factors,
+            design_matrix,
+            np.array([0.1, 0.1]),
+        )
+
+    np.testing.assert_array_equal(converged, [True, False])
+
+
+def test_cooks_distances_match_pydeseq2():
+    rng = np.random.default_rng(2)
+    num_samples, num_genes = 12, 30
+    design_matrix = pd.DataFrame(
+        {"intercept": 1.0, "condition_B_vs_A": np.repeat([0.0, 1.0], num_samples // 2)}
+    )
+    size_factors = rng.uniform(0.5, 2.0, num_samples)
+    counts = rng.negative_binomial(
+        5, 5 / (5 + rng.uniform(5, 200, num_genes) * size_factors[:, None])
+    ).astype(float)
+    counts[0, 0] = 5000
+    disp = np.full(num_genes, 0.2)
+    _, mu, H, _ = utils_CNaware.irls_glm_batch(
+        counts,
+        np.ones((num_samples, num_genes)),
+        size_factors,
+        design_matrix.to_numpy(),
+        disp,
+    )
+    normed_counts = counts / size_factors[:, None]
+    num_vars = design_matrix.shape[-1]
+
+    # Run pydeseq2's own implementation on the same fit
+    ref = SimpleNamespace(
+        X=counts,
+        n_obs=num_samples,
+        n_vars=num_genes,
+        obsm={"design_matrix": design_matrix, "_mu_LFC": mu, "_hat_diagonals": H},
+        varm={"dispersions": disp, "non_zero": np.ones(num_genes, dtype=bool)},
+        layers={"normed_counts": normed_counts},
+        quiet=True,
+        low_memory=False,
+    )
+    DeseqDataSet.calculate_cooks(ref)
+
+    cooks = utils_CNaware.cooks_distances(
+        counts,
+        mu,
+        robust_method_of_moments_disp(normed_counts, design_matrix),
+        H,
+        num_vars,
+    )
+
+    np.testing.assert_allclose(cooks, ref.layers["cooks"], rtol=1e-12)
+
+
+def test_cooks_distances_unit_leverage():
+    cooks = utils_CNaware.cooks_distances(
+        np.array([[5.0, 3.0]]),
+        np.array([[3.0, 3.0]]),
+        np.array([0.1, 0.1]),
+        np.ones((1, 2)),
+        2,
+    )
+
+    assert np.isposinf(cooks[0, 0])
+    assert np.isnan(cooks[0, 1])
+
+
+@pytest.mark.parametrize("num_vars, num_samples", [(2, 6), (2, 12), (3, 40)])
+def test_cooks_cutoff_matches_pydeseq2(num_vars, num_samples):
+    utils_CNaware.cooks_cutoff.cache_clear()
+
+    cutoff = utils_CNaware.cooks_cutoff(num_vars, num_samples)
+
+    # Same formula as in pydeseq2's DeseqStats
+    assert cutoff == f.ppf(0.99, num_vars, num_samples - num_vars)
+    assert utils_CNaware.cooks_cutoff(num_vars, num_samples) == cutoff
+    assert utils_CNaware.cooks_cutoff.cache_info().hits == 1
+
+
+@pytest.mark.parametrize("num_rows", [1, 2, 5, 10, 11])
+@pytest.mark.parametrize("trim", [0.0, 0.1, 0.2, 0.25, 0.5])
+def test_trimmed_mean_cols_matches_pydeseq2(num_rows, trim):
+    rng = np.random.default_rng(3)
+    # Small integers, so that columns have many ties, and continuous values
+    x = np.column_stack(
+        [rng.integers(0, 4, (num_rows, 5)), rng.normal(size=(num_rows, 5))]
+    ).astype(float)
+    x[:, 0] = 2.0
+
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        # Even numbers of rows trimmed by half leave empty slices
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = trimmed_mean(x, trim=trim, axis=0)
+
+    np.testing.assert_allclose(
+        utils_CNaware.trimmed_mean_cols(x, trim), expected, rtol=1e-12
+    )
+
+
+def sf_fixture():
+    rng = np.random.default_rng(4)
+    num_samples, num_genes = 8, 300
+    true_sf = rng.uniform(0.5, 2.0, num_samples)
+    base_mu = np.tile(rng.uniform(5.0, 500.0, num_genes), (num_samples, 1))
+    alpha = rng.uniform(0.05, 0.5, num_genes)
+    counts = rng.negative_binomial(
+        1 / alpha, 1 / (1 + alpha * base_mu * true_sf[:, None])
+    ).astype(float)
+    return counts, base_mu, alpha, np.log(true_sf)
+
+
+def test_trimmed_sf_nll_gradient():
+    counts, base_mu, alpha, log_sf = sf_fixture()
+    log_sf += np.random.default_rng(5).normal(scale=0.1, size=log_sf.size)
+
+    err = check_grad(
+        lambda p: utils_CNaware.trimmed_sf_nll(p, counts, base_mu, alpha)[0],
+        lambda p: utils_CNaware.trimmed_sf_nll(p, counts, base_mu, alpha)[1],
+        log_sf,
+    )
+
+    grad = utils_CNaware.trimmed_sf_nll(log_sf, counts, base_mu, alpha)[1]
+    assert err < 1e-4 * np.linalg.norm(grad)
+
+
+def test_trimmed_sf_nll_minimizer_matches_powell():
+    counts, base_mu, alpha, _ = sf_fixture()
+    x0 = np.zeros(counts.shape[0])
+
+    res = minimize(
+        utils_CNaware.trimmed_sf_nll,
+        x0,
+        args=(counts, base_mu, alpha),
+        jac=True,
+        method="L-BFGS-B",
+    )
+    # Value-only search, as in the original size factor fit, run to a tighter
+    # tolerance than its defaults
+    ref = minimize(
+        lambda p: utils_CNaware.trimmed_sf_nll(p, counts, base_mu, alpha)[0],
+        x0,
+        method="Powell",
+        options={"xtol": 1e-8, "ftol": 1e-12},
+    )
+
+    assert res.success and ref.success
+    np.testing.assert_allclose(
+        np.exp(res.x - res.x.mean()), np.exp(ref.x - ref.x.mean()), rtol=1e-5
+    )
+    assert res.fun <= ref.fun + 1e-6 * abs(ref.fun)